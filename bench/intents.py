@@ -0,0 +1,76 @@
+import argparse
+import sys
+
+from classifier import INTENT_THRESHOLD, score_intent
+
+# Table of messages and the intent the local classifier should settle on
+# (None = leave it to decision_prompt). Run after changing the rules or the threshold:
+#
+#   python -m bench.intents
+#   python -m bench.intents --threshold 0.7
+
+EXAMPLES = [
+    # create_task
+    ("buy milk", "create_task"),
+    ("call mom tomorrow", "create_task"),
+    ("pay rent next friday", "create_task"),
+    ("add buy milk", "create_task"),
+    ("remind me to water the plants", "create_task"),
+    ("i need to renew my passport", "create_task"),
+    # create_task that look like something else, the LLM decides
+    ("listen to the new podcast", None),
+    ("shower the dog", None),
+    ("whatsapp john about dinner", None),
+    ("complete the tax return by friday", None),
+    ("remove the stain from the carpet", None),
+    ("get the car service done", None),
+    ("make sure the laundry is done", None),
+    ("remember the invoice is done by friday", None),
+    ("mark zuckerberg email", None),
+    ("finish the quarterly report by end of next week", "create_task"),
+    # mark_as_done
+    ("mark buy milk done", "mark_as_done"),
+    ("mark the report as complete", "mark_as_done"),
+    ("done with call mom", "mark_as_done"),
+    ("finished the report", "mark_as_done"),
+    ("tick off groceries", "mark_as_done"),
+    ("buy milk is done", "mark_as_done"),
+    ("pay rent as done", "mark_as_done"),
+    # chat
+    ("show tasks", "chat"),
+    ("what is due this week?", "chat"),
+    ("what's due tomorrow", "chat"),
+    ("list my categories", "chat"),
+    ("do i have anything today", "chat"),
+    ("categories", "chat"),
+    ("check my tasks", None),
+    ("get my tasks", None),
+    # unknown
+    ("I should probably sort out the garage at some point", None),
+]
+
+
+def run(threshold):
+    failures = []
+    for text, expected in EXAMPLES:
+        intent, confidence = score_intent(text)
+        got = intent if intent is not None and confidence >= threshold else None
+        if got != expected:
+            failures.append((text, expected, intent, confidence))
+    return failures
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Check the local intent classifier against examples")
+    parser.add_argument("--threshold", type=float, default=INTENT_THRESHOLD)
+    args = parser.parse_args()
+
+    failures = run(args.threshold)
+    for text, expected, intent, confidence in failures:
+        print(f"MISMATCH: {text!r} expected {expected}, scored {intent} at {confidence:.2f}", file=sys.stderr)
+    print(f"{len(EXAMPLES) - len(failures)}/{len(EXAMPLES)} examples match at threshold {args.threshold}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,267 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.stubs import start_ollama_stub, start_telegram_stub
+
+# Offline latency benchmark: runs the pipeline against local Ollama/Telegram stubs
+# and reports p50/p95/p99 per stage. Run from the repo root:
+#
+#   python -m bench.run --requests 200 --delay default=0.3 --delay decision=0.1
+#   python -m bench.run --target webhook --updates recorded_updates.jsonl
+#   python -m bench.run --max-p95 total=1500 --max-p95 db=5   (exit 1 on regression)
+
+SYNTHETIC_TEXTS = [
+    "buy milk in 3 days",
+    "call mom tomorrow",
+    "pay rent next friday",
+    "show tasks",
+    "what is due this week?",
+    "mark buy milk done",
+    "done with call mom",
+    "finish the quarterly report by end of next week",
+    "I should probably sort out the garage at some point",
+    "categories",
+    "buy milk, call mom tomorrow, pay rent friday",
+]
+
+PROMPT_STAGES = {
+    "decision_prompt": "decision",
+    "create_task_prompt": "create_task",
+    "create_tasks_prompt": "create_tasks",
+    "assign_category_prompt": "category",
+    "date_prompt": "date",
+    "mark_as_done_prompt": "mark_as_done",
+    "chat_prompt": "chat",
+    "fused_prompt": "fused",
+}
+
+DB_FUNCTIONS = [
+    "get_or_create_user", "task_exists", "add_task", "get_pending_tasks", "get_pending_tasks_page",
+    "mark_task_done", "add_tasks", "mark_tasks_done", "get_categories",
+]
+
+_timings = defaultdict(list)
+_timings_lock = threading.Lock()
+
+
+def record(stage, seconds):
+    with _timings_lock:
+        _timings[stage].append(seconds)
+
+
+def timed(stage, fn):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record(stage, time.perf_counter() - started)
+    return wrapper
+
+
+# Wraps the stage entry points where the pipeline looks them up (the importing
+# module's namespace), stage timings include the DB reads they do
+def instrument():
+    import database
+    import prompt
+    import handlers.chat as chat
+    import telegram.callbacks as callbacks
+
+    consumers = [chat, callbacks, prompt]
+    for name, stage in PROMPT_STAGES.items():
+        for module in (chat, callbacks):
+            if hasattr(module, name):
+                setattr(module, name, timed(stage, getattr(prompt, name)))
+    for name in DB_FUNCTIONS:
+        wrapped = timed("db", getattr(database, name))
+        for module in consumers:
+            if hasattr(module, name):
+                setattr(module, name, wrapped)
+    callbacks.telegram_request = timed("send", callbacks.telegram_request)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    # Nearest-rank
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize():
+    summary = {}
+    with _timings_lock:
+        for stage, values in sorted(_timings.items()):
+            summary[stage] = {
+                "count": len(values),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": max(values) * 1000,
+            }
+    return summary
+
+
+def load_updates(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_update(i, text, users):
+    user = 1000 + i % users
+    return {
+        "update_id": i + 1,
+        "message": {
+            "message_id": i + 1,
+            "chat": {"id": user, "type": "private"},
+            "from": {"id": user, "first_name": "Bench"},
+            "text": text,
+        },
+    }
+
+
+def run_handler(args, texts):
+    import database
+    import handlers.chat as chat
+
+    handle = timed("total", chat.handle_user_input)
+    user_ids = [database.get_or_create_user(1000 + u) for u in range(args.users)]
+
+    def one(i):
+        try:
+            handle(texts[i % len(texts)], user_ids[i % len(user_ids)])
+        except Exception as e:
+            record("errors", 0.0)
+            print("ERROR:", e, file=sys.stderr)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(args.requests)))
+
+
+def run_webhook(args, updates):
+    import main
+    import telegram.updates as updates_module
+
+    updates_module.process_update = timed("update", updates_module.process_update)
+    client = main.app.test_client()
+
+    def one(i):
+        update = dict(updates[i % len(updates)], update_id=i + 1)
+        started = time.perf_counter()
+        res = client.post("/telegram/webhook", json=update)
+        record("webhook_ack", time.perf_counter() - started)
+        if res.status_code != 200:
+            record("errors", 0.0)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(args.requests)))
+    updates_module.drain_updates()
+
+
+def parse_pairs(pairs, cast=float):
+    result = {}
+    for pair in pairs or []:
+        key, value = pair.split("=", 1)
+        result[key] = cast(value)
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Offline TaskBot latency benchmark")
+    parser.add_argument("--target", choices=["handler", "webhook"], default="handler")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--delay", action="append", metavar="STAGE=SECONDS",
+                        help="LLM stub delay per stage (decision, create_task, create_tasks, category, date, "
+                             "mark_as_done, chat, fused, default)")
+    parser.add_argument("--telegram-delay", type=float, default=0.0)
+    parser.add_argument("--replies", help="JSON file with {stage: reply} overriding the canned replies")
+    parser.add_argument("--texts", help="file with one message text per line (handler target)")
+    parser.add_argument("--updates", help="JSONL file with recorded Telegram updates (webhook target)")
+    parser.add_argument("--llm-cache", action="store_true",
+                        help="serve repeated prompts from llm_cache (off by default, the synthetic "
+                             "texts repeat and cache hits would hide the pipeline)")
+    parser.add_argument("--max-p95", action="append", metavar="STAGE=MS",
+                        help="fail (exit 1) when a stage's p95 is above MS")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's debug output")
+    args = parser.parse_args()
+
+    replies = None
+    if args.replies:
+        with open(args.replies) as f:
+            replies = json.load(f)
+    ollama = start_ollama_stub(parse_pairs(args.delay), replies)
+    telegram = start_telegram_stub(args.telegram_delay)
+
+    # Must be set before the app modules read them at import time
+    workdir = tempfile.mkdtemp(prefix="taskbot-bench-")
+    os.environ["TASKBOT_PROMPT_ENDPOINT"] = f"http://127.0.0.1:{ollama.server_port}/api/chat"
+    os.environ["TASKBOT_TELEGRAM_API_BASE"] = f"http://127.0.0.1:{telegram.server_port}"
+    os.environ.setdefault("TASKBOT_TELEGRAM_TOKEN", "bench")
+    os.environ.setdefault("TASKBOT_TELEGRAM_CHAT_RATE", "1000")
+    os.environ.setdefault("TASKBOT_TELEGRAM_CHAT_BURST", "1000")
+    os.environ.setdefault("TASKBOT_TELEGRAM_GLOBAL_RATE", "1000")
+    os.environ.setdefault("TASKBOT_REMINDERS", "0")
+    if not args.llm_cache:
+        os.environ["TASKBOT_LLM_CACHE_STAGES"] = ""
+
+    import database
+    database.DB_PATH = os.path.join(workdir, "tasks.db")
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        database.init_db()
+        instrument()
+
+    # The app prints every system message, which would drown the report
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with quiet:
+        started = time.perf_counter()
+        if args.target == "handler":
+            texts = SYNTHETIC_TEXTS
+            if args.texts:
+                with open(args.texts) as f:
+                    texts = [line.strip() for line in f if line.strip()]
+            run_handler(args, texts)
+        else:
+            if args.updates:
+                updates = load_updates(args.updates)
+            else:
+                updates = [synthetic_update(i, t, args.users) for i, t in enumerate(SYNTHETIC_TEXTS)]
+            run_webhook(args, updates)
+        wall = time.perf_counter() - started
+
+    summary = summarize()
+    if args.json:
+        print(json.dumps({"wall_seconds": wall, "llm_calls": len(ollama.calls),
+                          "telegram_calls": len(telegram.sent), "stages": summary}, indent=2))
+    else:
+        print(f"{args.requests} requests in {wall:.2f}s, "
+              f"{len(ollama.calls)} LLM calls, {len(telegram.sent)} Telegram calls")
+        print(f"{'stage':<14}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for stage, s in summary.items():
+            print(f"{stage:<14}{s['count']:>7}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}"
+                  f"{s['p99_ms']:>10.1f}{s['max_ms']:>10.1f}")
+
+    failed = False
+    for stage, limit in parse_pairs(args.max_p95).items():
+        # A gate on a stage that never ran (or a typo) would pass on nothing
+        if stage not in summary:
+            print(f"REGRESSION: {stage} has no samples, nothing to check against {limit:.1f}ms", file=sys.stderr)
+            failed = True
+        elif summary[stage]["p95_ms"] > limit:
+            print(f"REGRESSION: {stage} p95 {summary[stage]['p95_ms']:.1f}ms > {limit:.1f}ms", file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,147 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-ins for the Ollama /api/chat endpoint and the Telegram Bot API,
+# so the pipeline can be driven without a model or a bot token.
+
+# Canned replies per stage, the stage is recognised from the system prompt
+CANNED = {
+    "decision": {"type": "create_task"},
+    # Beyond the local time parser, so every created task also measures date_prompt
+    "create_task": {"title": "Buy milk", "due": {"type": "relative", "value": "the week after next"}},
+    "create_tasks": {"tasks": [
+        {"title": "Buy milk", "due": None},
+        {"title": "Call mom", "due": {"type": "relative", "value": "tomorrow"}},
+    ]},
+    "category": {"category_id": None, "confidence": "low"},
+    "mark_as_done": {"task_id": None, "message": "Which task did you mean?"},
+    "chat": {"message": "You have a few tasks due this week."},
+    "date": {"time_expression": "in_2_weeks"},
+    "fused": {
+        "type": "create_task", "title": "Buy milk",
+        "due": {"type": "relative", "value": "in 3 days"},
+        "time_expression": "in_3_days", "category_id": None, "confidence": "low",
+    },
+}
+
+STAGE_MARKERS = [
+    ("fused", "extract everything needed"),
+    ("decision", "intent classifier"),
+    ("create_task", "You extract task information"),
+    ("create_tasks", "You extract a list of tasks"),
+    ("category", "assign a category"),
+    ("mark_as_done", "task selector"),
+    ("chat", "task advisor"),
+    ("date", "time expression extractor"),
+]
+
+
+def detect_stage(system_message):
+    for stage, marker in STAGE_MARKERS:
+        if marker in system_message:
+            return stage
+    return "unknown"
+
+
+def _start(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# delays: {stage: seconds}, "default" applies to stages not listed
+# replies: {stage: dict} overriding CANNED
+def start_ollama_stub(delays=None, replies=None, token_delay=0.02):
+    delays = delays or {}
+    replies = {**CANNED, **(replies or {})}
+    calls = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # otherwise delayed ACKs add ~40ms per call
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            system = next((m["content"] for m in payload["messages"] if m["role"] == "system"), "")
+            stage = detect_stage(system)
+            calls.append(stage)
+            time.sleep(delays.get(stage, delays.get("default", 0.0)))
+
+            content = json.dumps(replies.get(stage, {}))
+            if payload.get("stream"):
+                self._stream(replies.get(stage, {}).get("message", content))
+                return
+
+            body = json.dumps({
+                "model": payload.get("model"),
+                "message": {"role": "assistant", "content": content},
+                "done": True,
+                "prompt_eval_count": len(system) // 4,
+                "eval_count": len(content) // 4,
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _stream(self, text):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            words = text.split(" ")
+            for i, word in enumerate(words):
+                piece = word if i == len(words) - 1 else word + " "
+                self._chunk({"message": {"role": "assistant", "content": piece}, "done": False})
+                time.sleep(token_delay)
+            self._chunk({"message": {"role": "assistant", "content": ""}, "done": True})
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _chunk(self, data):
+            line = (json.dumps(data) + "\n").encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.flush()
+
+        def log_message(self, *args):
+            pass
+
+    server = _start(Handler)
+    server.calls = calls
+    return server
+
+
+def start_telegram_stub(delay=0.0):
+    sent = []
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # otherwise delayed ACKs add ~40ms per call
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            method = self.path.rsplit("/", 1)[-1]
+            time.sleep(delay)
+            with lock:
+                sent.append((method, payload))
+                message_id = len(sent)
+            body = json.dumps({
+                "ok": True,
+                "result": {"message_id": payload.get("message_id", message_id), "text": payload.get("text")},
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _start(Handler)
+    server.sent = sent
+    return server
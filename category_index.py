@@ -0,0 +1,217 @@
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+# Per-user BM25 index over category names and descriptions.
+# assign_category_prompt asks it first and only calls the LLM when the
+# best categories score too close to each other (or nothing matches).
+#
+# database.create_category adds new categories to the indexes already loaded.
+# Other processes can't do that, so after CATEGORY_INDEX_TTL the index is
+# reconciled with the category list passed to match_category.
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+NAME_WEIGHT = 2  # name words count as much as two description words
+
+# Scores are BM25 divided by the best score the query could reach in this user's
+# categories, so 0..1 whatever the number of categories.
+# Top score must be at least MIN_SCORE and beat the runner-up by MARGIN (relative)
+CATEGORY_MIN_SCORE = float(os.getenv("TASKBOT_CATEGORY_MIN_SCORE", "0.35"))
+CATEGORY_MARGIN = float(os.getenv("TASKBOT_CATEGORY_MARGIN", "0.5"))
+CATEGORY_INDEX_USERS = int(os.getenv("TASKBOT_CATEGORY_INDEX_USERS", "1024"))
+CATEGORY_INDEX_TTL = float(os.getenv("TASKBOT_CATEGORY_INDEX_TTL", "30"))
+
+# Optional CPU embedding model (sentence-transformers), used when BM25 is inconclusive
+EMBEDDING_MODEL = os.getenv("TASKBOT_CATEGORY_EMBEDDING_MODEL", "")
+EMBEDDING_MIN_SCORE = float(os.getenv("TASKBOT_CATEGORY_EMBEDDING_MIN_SCORE", "0.4"))
+EMBEDDING_MARGIN = float(os.getenv("TASKBOT_CATEGORY_EMBEDDING_MARGIN", "0.1"))
+
+STOP_WORDS = {
+    "the", "and", "for", "with", "from", "this", "that", "are", "was", "all",
+    "any", "can", "has", "have", "into", "not", "but", "our", "you", "your",
+    "about", "things", "stuff", "etc",
+}
+
+_WORD_RE = re.compile(r"\w+")
+
+_indexes = OrderedDict()  # user_id -> index dict
+_lock = threading.Lock()
+_embedder = None
+_embedder_loaded = False
+_stats = {"local": 0, "embedding": 0, "llm_fallback": 0}
+
+
+def tokenize(text):
+    tokens = []
+    for w in _WORD_RE.findall((text or "").lower()):
+        if len(w) < 3 or w in STOP_WORDS:
+            continue
+        # Cheap plural folding, "groceries" and "grocery" still differ but "bills"/"bill" don't
+        if len(w) > 3 and w.endswith("s") and not w.endswith("ss"):
+            w = w[:-1]
+        tokens.append(w)
+    return tokens
+
+
+def _new_index():
+    return {"docs": {}, "df": Counter(), "total_len": 0, "embeddings": {}, "synced_at": time.monotonic()}
+
+
+def _add_doc(index, category):
+    terms = Counter(tokenize(category["name"]) * NAME_WEIGHT)
+    terms.update(tokenize(category.get("description")))
+    index["docs"][category["id"]] = {
+        "terms": terms,
+        "len": sum(terms.values()),
+        "source": (category["name"], category.get("description")),
+    }
+    index["df"].update(terms.keys())
+    index["total_len"] += sum(terms.values())
+
+
+def _remove_doc(index, category_id):
+    doc = index["docs"].pop(category_id)
+    index["df"].subtract(doc["terms"].keys())
+    index["total_len"] -= doc["len"]
+    index["embeddings"].pop(category_id, None)
+
+
+def _get_index(user_id, categories):
+    index = _indexes.get(user_id)
+    if index is None:
+        index = _new_index()
+        _indexes[user_id] = index
+        while len(_indexes) > CATEGORY_INDEX_USERS:
+            _indexes.popitem(last=False)
+        _sync(index, categories)
+    elif time.monotonic() - index["synced_at"] > CATEGORY_INDEX_TTL:
+        _sync(index, categories)
+    _indexes.move_to_end(user_id)
+    return index
+
+
+def _sync(index, categories):
+    index["synced_at"] = time.monotonic()
+
+    current = {c["id"]: c for c in categories}
+    for category_id in [i for i in index["docs"] if i not in current]:
+        _remove_doc(index, category_id)
+    for category_id, c in current.items():
+        doc = index["docs"].get(category_id)
+        if doc is None:
+            _add_doc(index, c)
+        elif doc["source"] != (c["name"], c.get("description")):
+            _remove_doc(index, category_id)
+            _add_doc(index, c)
+
+
+# Called by database.create_category, only users with a loaded index are updated
+def index_category(user_id, category):
+    with _lock:
+        index = _indexes.get(user_id)
+        if index is None:
+            return
+        if category["id"] in index["docs"]:
+            _remove_doc(index, category["id"])
+        _add_doc(index, category)
+
+
+def _bm25(index, query_terms):
+    n = len(index["docs"])
+    avg_len = index["total_len"] / n if n else 0
+
+    def idf(term):
+        df = index["df"][term]
+        return math.log((n - df + 0.5) / (df + 0.5) + 1)
+
+    # Raw BM25 shifts with the corpus (a single category gives every term a low idf),
+    # the ceiling is what a document with all of the query's known terms at
+    # saturated tf would score. Terms no category contains can't be matched by any.
+    ceiling = sum(idf(term) * (BM25_K1 + 1) for term in set(query_terms) if index["df"][term] > 0)
+    if not ceiling:
+        return {category_id: 0.0 for category_id in index["docs"]}
+
+    scores = {}
+    for category_id, doc in index["docs"].items():
+        score = 0.0
+        for term in query_terms:
+            tf = doc["terms"].get(term)
+            if not tf:
+                continue
+            norm = 1 - BM25_B + BM25_B * (doc["len"] / avg_len if avg_len else 1)
+            score += idf(term) * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+        scores[category_id] = score / ceiling
+    return scores
+
+
+def _get_embedder():
+    global _embedder, _embedder_loaded
+    if _embedder_loaded:
+        return _embedder
+    _embedder_loaded = True
+    if not EMBEDDING_MODEL:
+        return None
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        print("WARNING: sentence-transformers not installed, category embeddings disabled")
+        return None
+    _embedder = SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+    return _embedder
+
+
+def _embedding_scores(index, title):
+    embedder = _get_embedder()
+    if embedder is None:
+        return None
+
+    missing = [i for i in index["docs"] if i not in index["embeddings"]]
+    if missing:
+        texts = [" - ".join(filter(None, index["docs"][i]["source"])) for i in missing]
+        for category_id, vector in zip(missing, embedder.encode(texts, normalize_embeddings=True)):
+            index["embeddings"][category_id] = vector
+
+    query = embedder.encode([title], normalize_embeddings=True)[0]
+    return {i: float(v @ query) for i, v in index["embeddings"].items()}
+
+
+def _best(scores, min_score, margin, relative):
+    if not scores:
+        return None
+    ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+    best_id, best = ranked[0]
+    second = ranked[1][1] if len(ranked) > 1 else 0.0
+    gap = (best - second) / best if relative and best else best - second
+    if best >= min_score and gap >= margin:
+        return best_id
+    return None
+
+
+# Returns {"category_id", "confidence"} like assign_category_prompt, or None when unsure
+def match_category(user_id, title, categories):
+    with _lock:
+        index = _get_index(user_id, categories)
+        category_id = _best(_bm25(index, tokenize(title)), CATEGORY_MIN_SCORE, CATEGORY_MARGIN, True)
+        if category_id is not None:
+            _stats["local"] += 1
+            return {"category_id": category_id, "confidence": "high"}
+
+        scores = _embedding_scores(index, title)
+        category_id = _best(scores, EMBEDDING_MIN_SCORE, EMBEDDING_MARGIN, False)
+        if category_id is not None:
+            _stats["embedding"] += 1
+            return {"category_id": category_id, "confidence": "high"}
+
+        _stats["llm_fallback"] += 1
+        return None
+
+
+def category_index_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["users"] = len(_indexes)
+    return stats
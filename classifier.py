@@ -0,0 +1,118 @@
+import os
+import re
+import threading
+
+# Rule/lexicon intent classifier that runs before decision_prompt.
+# It only answers when it is confident, everything else goes to the LLM.
+
+INTENT_THRESHOLD = float(os.getenv("TASKBOT_INTENT_THRESHOLD", "0.8"))
+
+# Scores above INTENT_THRESHOLD answer locally, the weak ones only say which way a
+# message leans and leave the decision to the LLM.
+# bench/intents.py checks these rules against a table of examples.
+MARK_DONE_PREFIXES = ("done with ", "finished ", "completed ", "tick off ", "check off ")
+MARK_DONE_SUFFIXES = (" as done", " is done")
+# "mark" is also a name ("mark zuckerberg email"), it needs a done word at the end
+MARK_ENDINGS = (" done", " complete", " completed", " finished", " off")
+# "make sure the laundry is done" asks for a task, the suffix alone doesn't settle it
+CREATE_CUES = (" make sure ", " remember ", " ensure ", " need to ", " have to ", " should ",
+               " must ", " don't forget ", " dont forget ", " remind me ")
+# "complete the tax return", "remove the stain", "get the car service done" are tasks
+WEAK_MARK_DONE_PREFIXES = ("mark ", "complete ", "remove ", "delete ")
+WEAK_MARK_DONE_SUFFIXES = (" done", " finished", " completed")
+
+CREATE_PREFIXES = ("add ", "create ", "new task", "remind me to ", "remind me ",
+                   "i need to ", "i have to ", "i must ", "don't forget to ", "dont forget to ")
+
+# Matched against the first word only, so "listen", "shower" or "whatsapp" don't count
+CHAT_WORDS = {"show", "list", "what", "what's", "whats", "which", "when", "how", "why",
+              "who", "where", "help"}
+CHAT_PREFIXES = ("do i ", "are there ", "is there ", "can you ", "tell me ")
+
+# Imperative verbs that start a typical task title ("buy milk", "call mom")
+CREATE_VERBS = {
+    "buy", "call", "pay", "finish", "read", "write", "send", "apply", "book",
+    "clean", "email", "fix", "make", "pick", "schedule", "submit", "visit",
+    "prepare", "order", "return", "renew", "cook", "wash", "study", "learn",
+    "meet", "plan", "print", "post", "sign", "text", "water", "feed", "walk",
+    "bring", "get", "go", "take", "check", "update", "review", "organize",
+    "practice", "ask", "reply", "answer", "install", "cancel", "collect",
+}
+# Also common in questions about the task list ("check my tasks", "get my tasks")
+AMBIGUOUS_VERBS = {"get", "go", "check", "take", "make", "plan", "review", "update"}
+
+WEAK_SCORE = 0.6
+
+_WORD_RE = re.compile(r"[a-z']+")
+
+_stats_lock = threading.Lock()
+_stats = {
+    "rules": 0,
+    "llm_fallback": 0,
+    "create_task": 0,
+    "mark_as_done": 0,
+    "chat": 0,
+}
+
+
+def _marks_done(t: str) -> bool:
+    if t.startswith(MARK_DONE_PREFIXES):
+        return True
+    if t.startswith("mark ") and t.endswith(MARK_ENDINGS):
+        return True
+    return t.endswith(MARK_DONE_SUFFIXES) and not any(cue in f" {t} " for cue in CREATE_CUES)
+
+
+def score_intent(text: str) -> tuple[str | None, float]:
+    t = " ".join(text.lower().split())
+    if not t:
+        return "chat", 1.0
+
+    words = _WORD_RE.findall(t)
+
+    if _marks_done(t):
+        return "mark_as_done", 0.95
+
+    if t.endswith("?") or words[:1] and words[0] in CHAT_WORDS or t.startswith(CHAT_PREFIXES):
+        return "chat", 0.9
+
+    if t.startswith(CREATE_PREFIXES):
+        return "create_task", 0.95
+
+    # Single words are listings or vague references, never tasks
+    if len(words) <= 1:
+        return "chat", 0.9
+
+    if t.startswith(WEAK_MARK_DONE_PREFIXES) or t.endswith(WEAK_MARK_DONE_SUFFIXES):
+        return "mark_as_done", WEAK_SCORE
+
+    if words[0] in AMBIGUOUS_VERBS:
+        return "create_task", WEAK_SCORE
+
+    if words[0] in CREATE_VERBS:
+        return "create_task", 0.85
+
+    return None, 0.0
+
+
+def classify_intent(text: str, threshold: float | None = None) -> dict | None:
+    intent, confidence = score_intent(text)
+    if threshold is None:
+        threshold = INTENT_THRESHOLD
+
+    with _stats_lock:
+        if intent is None or confidence < threshold:
+            _stats["llm_fallback"] += 1
+            return None
+        _stats["rules"] += 1
+        _stats[intent] += 1
+
+    return {"type": intent, "confidence": confidence}
+
+
+def intent_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats["rules"] + stats["llm_fallback"]
+    stats["rules_ratio"] = stats["rules"] / total if total else 0.0
+    return stats
@@ -1,18 +1,49 @@
 import json
+import os
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+import reminders
+import category_index
+import task_index
 
 DB_PATH = "db/tasks.db"
+BUSY_TIMEOUT_MS = int(os.getenv("TASKBOT_DB_BUSY_TIMEOUT_MS", "5000"))
+
+# One connection per thread (and per process, so gunicorn forks never share
+# a handle). "with get_connection() as conn" commits/rolls back but keeps it open.
+_local = threading.local()
+
 
 # INIT DB
-def get_connection():
-    conn = sqlite3.connect(DB_PATH)
+def _open_connection():
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};")
+    # WAL + NORMAL is durable against app crashes, only an OS crash can lose the last commit
+    conn.execute("PRAGMA synchronous = NORMAL;")
     conn.execute("PRAGMA foreign_keys = ON;")
     return conn
 
-def init_db():
-    with get_connection() as conn:
-        conn.execute("""
+
+def get_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = _open_connection()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+# Schema migrations, applied in order and tracked in PRAGMA user_version.
+# Never edit a released migration, append a new one instead.
+MIGRATIONS = [
+    (1, [
+        """
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             telegram_user_id INTEGER UNIQUE NOT NULL,
@@ -20,9 +51,8 @@ def init_db():
             first_name TEXT,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
             );
-        """)
-
-        conn.execute("""
+        """,
+        """
             CREATE TABLE IF NOT EXISTS tasks (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -36,9 +66,8 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users(id),
             FOREIGN KEY (category_id) REFERENCES categories(id)
             );
-        """)
-
-        conn.execute("""CREATE TABLE IF NOT EXISTS categories (
+        """,
+        """CREATE TABLE IF NOT EXISTS categories (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
             name TEXT NOT NULL,
@@ -48,42 +77,232 @@ def init_db():
             UNIQUE (user_id, name),
             FOREIGN KEY (user_id) REFERENCES users(id)
             );
-        """)
-
-        conn.execute("""CREATE TABLE IF NOT EXISTS user_states (
+        """,
+        """CREATE TABLE IF NOT EXISTS user_states (
             user_id INTEGER PRIMARY KEY,
             state TEXT NOT NULL,
             draft_json TEXT,
             updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
             );
-        """)
+        """,
+    ]),
+    (2, [
+        """CREATE INDEX IF NOT EXISTS idx_tasks_user_status_due
+            ON tasks (user_id, status, due_at);
+        """,
+        """CREATE INDEX IF NOT EXISTS idx_tasks_user_status_title
+            ON tasks (user_id, status, lower(title));
+        """,
+        """CREATE INDEX IF NOT EXISTS idx_categories_user_name
+            ON categories (user_id, lower(name));
+        """,
+    ]),
+    (3, [
+        "ALTER TABLE tasks ADD COLUMN reminded_at DATETIME;",
+        # Only tasks still waiting for a reminder, so the index stays small
+        """CREATE INDEX IF NOT EXISTS idx_tasks_reminder_due
+            ON tasks (due_at)
+            WHERE status = 'pending' AND reminded_at IS NULL AND due_at IS NOT NULL;
+        """,
+    ]),
+]
+
+# Keyset pagination over (due_at, id), undated tasks first like get_pending_tasks.
+# Row values can't compare NULLs, so a cursor on an undated task has its own query.
+TASK_PAGE_SIZE = int(os.getenv("TASKBOT_TASK_PAGE_SIZE", "8"))
+_TASK_PAGE_SELECT = (
+    "SELECT id, title, category_id, due_at FROM tasks"
+    " WHERE user_id = ? AND status = 'pending'"
+)
+_TASK_PAGE_ORDER = " ORDER BY due_at ASC, id ASC LIMIT ?"
+TASK_PAGE_FIRST_SQL = _TASK_PAGE_SELECT + _TASK_PAGE_ORDER
+TASK_PAGE_AFTER_UNDATED_SQL = _TASK_PAGE_SELECT + " AND (due_at IS NOT NULL OR id > ?)" + _TASK_PAGE_ORDER
+TASK_PAGE_AFTER_SQL = _TASK_PAGE_SELECT + " AND (due_at, id) > (?, ?)" + _TASK_PAGE_ORDER
+
+# Tasks due in [start, end] that haven't been reminded yet, served by idx_tasks_reminder_due
+REMINDER_WINDOW_SQL = (
+    "SELECT id, user_id, title, due_at FROM tasks"
+    " WHERE status = 'pending' AND reminded_at IS NULL AND due_at IS NOT NULL"
+    " AND due_at BETWEEN ? AND ? ORDER BY due_at ASC, id ASC LIMIT ?"
+)
+
+PENDING_TASKS_SQL = (
+    "SELECT id, title, category_id, due_at FROM tasks"
+    " WHERE user_id = ? AND status = 'pending' ORDER BY due_at ASC"
+)
+TASK_EXISTS_BY_TITLE_SQL = (
+    "SELECT 1 FROM tasks WHERE user_id = ? AND lower(title) = lower(?) AND status = 'pending'"
+)
+CATEGORY_EXISTS_SQL = (
+    "SELECT 1 FROM categories WHERE user_id = ? AND lower(name) = lower(?) AND is_active = 1"
+)
+CATEGORIES_SQL = (
+    "SELECT id, name, description FROM categories"
+    " WHERE user_id = ? AND is_active = 1 ORDER BY name"
+)
+
+# Hot queries that must be served from an index, see check_query_plans().
+# Same constants the functions run, so an edit there can't slip past the check.
+HOT_QUERIES = {
+    "get_pending_tasks_page": (TASK_PAGE_FIRST_SQL, (1, 8)),
+    "get_pending_tasks_page_after": (TASK_PAGE_AFTER_SQL, (1, "2026-01-01", 1, 8)),
+    "get_pending_tasks": (PENDING_TASKS_SQL, (1,)),
+    "task_exists_by_title": (TASK_EXISTS_BY_TITLE_SQL, (1, "x")),
+    "get_reminder_window": (REMINDER_WINDOW_SQL, ("2026-01-01", "2026-01-02", 1000)),
+    "category_exists": (CATEGORY_EXISTS_SQL, (1, "x")),
+    "get_categories": (CATEGORIES_SQL, (1,)),
+}
+
+
+def migrate(conn):
+    for version, statements in MIGRATIONS:
+        # IMMEDIATE takes the write lock first, so two workers starting
+        # together cannot both apply the same migration
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version <= current:
+                conn.rollback()
+                continue
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def check_query_plans(conn=None):
+    conn = conn or get_connection()
+    problems = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row["detail"]
+            # SEARCH is an index lookup, SCAN walks the whole table (or index)
+            if detail.startswith("SCAN") or "TEMP B-TREE" in detail:
+                problems.append(f"{name}: {detail}")
+    if problems:
+        raise RuntimeError("Hot queries without index: " + "; ".join(problems))
+
+
+def init_db():
+    conn = get_connection()
+    migrate(conn)
+    check_query_plans(conn)
+
+
+def _timed_query(name):
+    return metrics.timed("taskbot_db_query_seconds", query=name)
+
+
+metrics.describe(
+    "taskbot_db_query_seconds", "database.py call latency",
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+)
+
+
+############# READ CACHE ###############
+# Per-user cache for pending tasks and categories, invalidated by the writers below.
+# Other processes can't invalidate it, so entries also expire after READ_CACHE_TTL.
+READ_CACHE_USERS = int(os.getenv("TASKBOT_READ_CACHE_USERS", "1024"))
+READ_CACHE_TTL = float(os.getenv("TASKBOT_READ_CACHE_TTL", "30"))
+
+_read_cache = OrderedDict()  # user_id -> {kind: (expires_at, rows)}
+# (user_id, kind) -> [readers, generation], only while a load is running. Writers bump
+# the generation so the readers know their rows are stale. Gone once the last reader is done.
+_read_inflight = {}
+_read_cache_lock = threading.Lock()
+_read_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _cached_read(user_id, kind, load):
+    now = time.monotonic()
+    with _read_cache_lock:
+        entry = _read_cache.get(user_id, {}).get(kind)
+        if entry and entry[0] > now:
+            _read_cache.move_to_end(user_id)
+            _read_cache_stats["hits"] += 1
+            return [dict(row) for row in entry[1]]
+        _read_cache_stats["misses"] += 1
+        inflight = _read_inflight.setdefault((user_id, kind), [0, 0])
+        inflight[0] += 1
+        generation = inflight[1]
+
+    rows = None
+    try:
+        rows = load()
+    finally:
+        with _read_cache_lock:
+            inflight[0] -= 1
+            if inflight[0] == 0:
+                del _read_inflight[(user_id, kind)]
+            # A write that happened while we were reading makes these rows stale
+            if rows is not None and inflight[1] == generation:
+                _read_cache.setdefault(user_id, {})[kind] = (now + READ_CACHE_TTL, rows)
+                _read_cache.move_to_end(user_id)
+                while len(_read_cache) > READ_CACHE_USERS:
+                    _read_cache.popitem(last=False)
+
+    return [dict(row) for row in rows]
+
+
+def invalidate_user_cache(user_id, kind):
+    with _read_cache_lock:
+        inflight = _read_inflight.get((user_id, kind))
+        if inflight is not None:
+            inflight[1] += 1
+        _read_cache.get(user_id, {}).pop(kind, None)
+
+
+def read_cache_stats():
+    with _read_cache_lock:
+        stats = dict(_read_cache_stats)
+        stats["users"] = len(_read_cache)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
 
 ############# USER ###############
-def get_or_create_user(telegram_user_id, username=None, first_name=None):
-    with get_connection() as conn:
-        user = conn.execute(
-            "SELECT id FROM users WHERE telegram_user_id = ?",
-            (telegram_user_id,)
-        ).fetchone()
+# telegram_user_id -> users.id, ids never change so entries never go stale
+USER_ID_CACHE_SIZE = int(os.getenv("TASKBOT_USER_ID_CACHE_SIZE", "10000"))
+_user_ids = OrderedDict()
+_user_ids_lock = threading.Lock()
 
-        if user:
-            return user["id"]
 
-        conn.execute(
+@_timed_query("get_or_create_user")
+def get_or_create_user(telegram_user_id, username=None, first_name=None):
+    with _user_ids_lock:
+        user_id = _user_ids.get(telegram_user_id)
+        if user_id is not None:
+            _user_ids.move_to_end(telegram_user_id)
+            return user_id
+
+    # One atomic statement, so two first messages from the same user can't race
+    with get_connection() as conn:
+        user_id = conn.execute(
             """
             INSERT INTO users (telegram_user_id, username, first_name)
             VALUES (?, ?, ?)
+            ON CONFLICT(telegram_user_id) DO UPDATE SET
+                username = COALESCE(excluded.username, username),
+                first_name = COALESCE(excluded.first_name, first_name)
+            RETURNING id
             """,
             (telegram_user_id, username, first_name)
-        )
-
-        return conn.execute(
-            "SELECT id FROM users WHERE telegram_user_id = ?",
-            (telegram_user_id,)
         ).fetchone()["id"]
 
+    with _user_ids_lock:
+        _user_ids[telegram_user_id] = user_id
+        while len(_user_ids) > USER_ID_CACHE_SIZE:
+            _user_ids.popitem(last=False)
+
+    return user_id
+
 
 ############# TASKS ###############
+@_timed_query("task_exists")
 def task_exists(user_id, *, task_id=None, title=None):
     if task_id is not None:
         with get_connection() as conn:
@@ -100,47 +319,102 @@ def task_exists(user_id, *, task_id=None, title=None):
 
     elif title is not None:
         with get_connection() as conn:
-            row = conn.execute(
-                """
-                SELECT 1 FROM tasks
-                WHERE user_id = ?
-                  AND lower(title) = lower(?)
-                  AND status = 'pending'
-                """,
-                (user_id, title.strip())
-            ).fetchone()
+            row = conn.execute(TASK_EXISTS_BY_TITLE_SQL, (user_id, title.strip())).fetchone()
         return row is not None
 
     else:
         raise ValueError("task_id or title required")
 
 
+@_timed_query("add_task")
 def add_task(user_id, title, description=None, due_at=None, category_id=None):
     with get_connection() as conn:
-        conn.execute(
+        # A task created after its reminder time has nothing left to remind about
+        task_id = conn.execute(
+            """
+            INSERT INTO tasks (user_id, title, description, due_at, category_id, reminded_at)
+            VALUES (?, ?, ?, ?, ?, CASE WHEN ? THEN CURRENT_TIMESTAMP END)
+            """,
+            (user_id, title, description, due_at, category_id, reminders.is_past(due_at))
+        ).lastrowid
+    invalidate_user_cache(user_id, "tasks")
+    task_index.index_task(user_id, task_id, title)
+    reminders.schedule_task(task_id, user_id, title, due_at)
+    return task_id
+
+
+# tasks: list of dicts with title and optional description, due_at, category_id.
+# One transaction for the whole batch, returns the new ids in order.
+@_timed_query("add_tasks")
+def add_tasks(user_id, tasks):
+    if not tasks:
+        return []
+    rows = [
+        (user_id, t["title"], t.get("description"), t.get("due_at"), t.get("category_id"),
+         reminders.is_past(t.get("due_at")))
+        for t in tasks
+    ]
+    with get_connection() as conn:
+        conn.executemany(
             """
-            INSERT INTO tasks (user_id, title, description, due_at, category_id)
-            VALUES (?, ?, ?, ?, ?)
+            INSERT INTO tasks (user_id, title, description, due_at, category_id, reminded_at)
+            VALUES (?, ?, ?, ?, ?, CASE WHEN ? THEN CURRENT_TIMESTAMP END)
             """,
-            (user_id, title, description, due_at, category_id)
+            rows
         )
+        # The write lock is held for the whole transaction, so AUTOINCREMENT ids are consecutive
+        last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    task_ids = list(range(last_id - len(rows) + 1, last_id + 1))
+    invalidate_user_cache(user_id, "tasks")
+    for task_id, t in zip(task_ids, tasks):
+        task_index.index_task(user_id, task_id, t["title"])
+        reminders.schedule_task(task_id, user_id, t["title"], t.get("due_at"))
+    return task_ids
 
 
 def get_pending_tasks(user_id):
+    return _cached_read(user_id, "tasks", lambda: _load_pending_tasks(user_id))
+
+
+@_timed_query("get_pending_tasks")
+def _load_pending_tasks(user_id):
     with get_connection() as conn:
-        rows = conn.execute(
-            """
-            SELECT id, title, category_id, due_at
-            FROM tasks
-            WHERE user_id = ? AND status = 'pending'
-            ORDER BY due_at ASC
-            """,
-            (user_id,)
-        ).fetchall()
+        rows = conn.execute(PENDING_TASKS_SQL, (user_id,)).fetchall()
 
         return [dict(row) for row in rows]
 
 
+# Cursors are "<due_at or ->_<id>", short enough for Telegram's 64 byte callback_data
+def encode_task_cursor(task):
+    return f"{task['due_at'] or '-'}_{task['id']}"
+
+
+def decode_task_cursor(cursor):
+    due_at, _, task_id = cursor.rpartition("_")
+    return (None if due_at == "-" else due_at), int(task_id)
+
+
+# Returns (tasks, next_cursor), next_cursor is None on the last page
+@_timed_query("get_pending_tasks_page")
+def get_pending_tasks_page(user_id, cursor=None, limit=TASK_PAGE_SIZE):
+    if cursor is None:
+        sql, params = TASK_PAGE_FIRST_SQL, (user_id, limit + 1)
+    else:
+        due_at, task_id = decode_task_cursor(cursor)
+        if due_at is None:
+            sql, params = TASK_PAGE_AFTER_UNDATED_SQL, (user_id, task_id, limit + 1)
+        else:
+            sql, params = TASK_PAGE_AFTER_SQL, (user_id, due_at, task_id, limit + 1)
+
+    with get_connection() as conn:
+        rows = [dict(row) for row in conn.execute(sql, params).fetchall()]
+
+    if len(rows) > limit:
+        return rows[:limit], encode_task_cursor(rows[limit - 1])
+    return rows, None
+
+
+@_timed_query("mark_task_done")
 def mark_task_done(user_id, task_id):
     with get_connection() as conn:
         conn.execute(
@@ -152,46 +426,108 @@ def mark_task_done(user_id, task_id):
             """,
             (task_id, user_id)
         )
+    invalidate_user_cache(user_id, "tasks")
+    task_index.unindex_task(user_id, task_id)
+    reminders.unschedule_task(task_id)
 
 
-############# CATEGORIES ###############
-def category_exists(user_id, name):
+@_timed_query("mark_tasks_done")
+def mark_tasks_done(user_id, task_ids):
+    if not task_ids:
+        return
     with get_connection() as conn:
-        row = conn.execute(
+        conn.executemany(
             """
-            SELECT 1 FROM categories
-            WHERE user_id = ? AND lower(name) = lower(?)
-            AND is_active = 1
+            UPDATE tasks
+            SET status = 'done',
+                completed_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND user_id = ?
             """,
-            (user_id, name)
-        ).fetchone()
+            [(task_id, user_id) for task_id in task_ids]
+        )
+    invalidate_user_cache(user_id, "tasks")
+    for task_id in task_ids:
+        task_index.unindex_task(user_id, task_id)
+        reminders.unschedule_task(task_id)
+
+
+# The reminder scheduler's range load, at most limit rows
+@_timed_query("get_reminder_window")
+def get_reminder_window(start, end, limit):
+    with get_connection() as conn:
+        rows = conn.execute(REMINDER_WINDOW_SQL, (start, end, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+
+# Marks the tasks reminded and returns (task id, telegram user id) for the ones this call
+# claimed, so several processes running the scheduler never send the same reminder twice
+@_timed_query("claim_reminders")
+def claim_reminders(task_ids):
+    if not task_ids:
+        return []
+    placeholders = ",".join("?" * len(task_ids))
+    with get_connection() as conn:
+        claimed = [
+            row[0] for row in conn.execute(
+                f"""
+                UPDATE tasks
+                SET reminded_at = CURRENT_TIMESTAMP
+                WHERE id IN ({placeholders})
+                  AND status = 'pending'
+                  AND reminded_at IS NULL
+                RETURNING id
+                """,
+                list(task_ids)
+            ).fetchall()
+        ]
+        if not claimed:
+            return []
+        rows = conn.execute(
+            f"""
+            SELECT t.id, u.telegram_user_id
+            FROM tasks t JOIN users u ON u.id = t.user_id
+            WHERE t.id IN ({",".join("?" * len(claimed))})
+            """,
+            claimed
+        ).fetchall()
+    return [(row[0], row[1]) for row in rows]
+
+
+############# CATEGORIES ###############
+@_timed_query("category_exists")
+def category_exists(user_id, name):
+    with get_connection() as conn:
+        row = conn.execute(CATEGORY_EXISTS_SQL, (user_id, name)).fetchone()
         return row is not None
 
+@_timed_query("create_category")
 def create_category(user_id, name, description=None):
     with get_connection() as conn:
-        conn.execute(
+        cur = conn.execute(
             """
             INSERT OR IGNORE INTO categories (user_id, name, description)
             VALUES (?, ?, ?)
             """,
             (user_id, name, description)
         )
+    invalidate_user_cache(user_id, "categories")
+    # rowcount is 0 when the name already existed
+    if cur.rowcount == 1:
+        category_index.index_category(user_id, {"id": cur.lastrowid, "name": name, "description": description})
 
 def get_categories(user_id):
+    return _cached_read(user_id, "categories", lambda: _load_categories(user_id))
+
+
+@_timed_query("get_categories")
+def _load_categories(user_id):
     with get_connection() as conn:
-        rows = conn.execute(
-            """
-            SELECT id, name, description
-            FROM categories
-            WHERE user_id = ? AND is_active = 1
-            ORDER BY name
-            """,
-            (user_id,)
-        ).fetchall()
+        rows = conn.execute(CATEGORIES_SQL, (user_id,)).fetchall()
 
         return [dict(row) for row in rows]
 
 
+@_timed_query("get_user_state")
 def get_user_state(user_id):
     with get_connection() as conn:
         row = conn.execute(
@@ -207,6 +543,7 @@ def get_user_state(user_id):
     }
 
 
+@_timed_query("set_user_state")
 def set_user_state(user_id, state, draft=None):
     draft_json = json.dumps(draft or {})
     with get_connection() as conn:
@@ -224,6 +561,7 @@ def set_user_state(user_id, state, draft=None):
         )
 
 
+@_timed_query("clear_user_state")
 def clear_user_state(user_id):
     with get_connection() as conn:
         conn.execute(
@@ -232,3 +570,50 @@ def clear_user_state(user_id):
     )
 
 
+
+
+# Batch access for state_store: rows touched within max_age_seconds, older ones are deleted
+@_timed_query("load_user_states")
+def load_user_states(max_age_seconds):
+    with get_connection() as conn:
+        conn.execute(
+            "DELETE FROM user_states WHERE updated_at < datetime('now', ?)",
+            (f"-{int(max_age_seconds)} seconds",)
+        )
+        rows = conn.execute(
+            """
+            SELECT user_id, state, draft_json, CAST(strftime('%s', updated_at) AS REAL) AS updated_ts
+            FROM user_states
+            """
+        ).fetchall()
+    return [
+        {
+            "user_id": row["user_id"],
+            "state": row["state"],
+            "draft": json.loads(row["draft_json"]) if row["draft_json"] else {},
+            "updated_ts": row["updated_ts"],
+        }
+        for row in rows
+    ]
+
+
+# upserts: [(user_id, state, draft, updated_ts)], deletes: [user_id], one transaction
+@_timed_query("write_user_states")
+def write_user_states(upserts, deletes):
+    with get_connection() as conn:
+        conn.executemany(
+            """
+            INSERT INTO user_states (user_id, state, draft_json, updated_at)
+            VALUES (?, ?, ?, datetime(?, 'unixepoch'))
+            ON CONFLICT(user_id)
+            DO UPDATE SET
+                state = excluded.state,
+                draft_json = excluded.draft_json,
+                updated_at = excluded.updated_at
+            """,
+            [(user_id, state, json.dumps(draft or {}), ts) for user_id, state, draft, ts in upserts]
+        )
+        conn.executemany(
+            "DELETE FROM user_states WHERE user_id = ?",
+            [(user_id,) for user_id in deletes]
+        )
@@ -1,53 +1,67 @@
 from database import *
 from datetime import date
-from preprocessing import resolve_time_expression, normalize_due_date
+from classifier import classify_intent
+from stages import run_stages
+from category_index import match_category
+from preprocessing import resolve_time_expression, normalize_due_date, parse_time_expression, split_items
 from prompt import (
     decision_prompt,
     create_task_prompt,
+    create_tasks_prompt,
     assign_category_prompt,
     mark_as_done_prompt,
     chat_prompt,
-    date_prompt
+    date_prompt,
+    fused_prompt,
+    PIPELINE_MODE
 )
 
 def handle_user_input(text: str, user_id: int) -> str:
-    decision = decision_prompt(text)
+    # Unambiguous messages are classified locally, the LLM only sees the rest
+    decision = classify_intent(text)
+    # "buy milk, call mom tomorrow" is extracted in one call and saved in one transaction
+    is_list = len(split_items(text)) > 1
+
+    if PIPELINE_MODE == "fused" and not is_list and (decision is None or decision["type"] == "create_task"):
+        extraction = fused_prompt(text, user_id)
+        if extraction is not None and extraction["type"] == "create_task":
+            return save_task(
+                user_id,
+                extraction,
+                extraction["category_id"],
+                extraction["time_expression"]
+            )
+        if extraction is not None:
+            decision = extraction
+        else:
+            print("DEBUG: fused extraction invalid, falling back to staged pipeline")
+
+    if decision is None:
+        decision = decision_prompt(text)
 
     match decision["type"]:
+        case "create_task" if is_list:
+            return save_tasks(user_id, create_tasks_prompt(text).get("tasks") or [])
+
         case "create_task":
-            task = create_task_prompt(text)
-            category = assign_category_prompt(text,user_id)
+            # Title extraction and category assignment don't depend on each other
+            results, errors = run_stages({
+                "create_task": (create_task_prompt, (text,)),
+                "assign_category": (assign_category_prompt, (text, user_id)),
+            })
+            if "create_task" in errors:
+                print("DEBUG: create_task stage failed:", errors["create_task"])
+                return "I couldn't determine the task title."
+            task = results["create_task"]
+            category = results.get("assign_category") or {}
             if category.get('category_id') is None or category.get('confidence') != "high":
                 # show_category_buttons()
                 print("DEBUG: Category null or confidence is not high")
                 category_id = None
             else:
                 category_id = category.get('category_id')
-            if not task.get("title"):
-                return "I couldn't determine the task title."
 
-            if task_exists(user_id, title=task["title"]):
-                return "That task already exists."
-            due = task.get("due")
-            if not due:
-                due_at = None
-            elif due["type"] == "relative":
-                time_expr = date_prompt(due["value"])["time_expression"]
-                due_date = resolve_time_expression(time_expr, date.today())
-                due_at = due_date.isoformat() if due_date else None
-            elif due["type"] == "absolute":
-                due_at = normalize_due_date(due["value"])
-            else:
-                due_at = None
-
-            add_task(
-                user_id=user_id,
-                title=task["title"].strip(),
-                due_at=due_at,
-                category_id=category_id
-            )
-
-            return f"Task '{task['title']}' saved."
+            return save_task(user_id, task, category_id)
 
         case "mark_as_done":
             data = mark_as_done_prompt(text, user_id)
@@ -63,3 +77,71 @@ def handle_user_input(text: str, user_id: int) -> str:
 
         case _:
             return chat_prompt(text, user_id)
+
+
+def save_task(user_id: int, task: dict, category_id, time_expr=None) -> str:
+    if not task.get("title"):
+        return "I couldn't determine the task title."
+
+    if task_exists(user_id, title=task["title"]):
+        return "That task already exists."
+    due_at = resolve_due(task.get("due"), time_expr)
+
+    add_task(
+        user_id=user_id,
+        title=task["title"].strip(),
+        due_at=due_at,
+        category_id=category_id
+    )
+
+    return f"Task '{task['title']}' saved."
+
+
+def save_tasks(user_id: int, tasks: list) -> str:
+    rows = []
+    skipped = 0
+    # One read for all the duplicate checks instead of task_exists per item
+    seen = {t["title"].strip().lower() for t in get_pending_tasks(user_id)}
+    categories = get_categories(user_id)
+    for task in tasks:
+        title = (task.get("title") or "").strip()
+        if not title or title.lower() in seen:
+            skipped += 1
+            continue
+        seen.add(title.lower())
+        # Only the local matcher, one LLM call per item would undo the point of batching
+        category = match_category(user_id, title, categories) if categories else None
+        rows.append({
+            "title": title,
+            "due_at": resolve_due(task.get("due")),
+            "category_id": category["category_id"] if category else None,
+        })
+
+    if not rows:
+        return "Those tasks already exist." if skipped else "I couldn't determine the task titles."
+
+    add_tasks(user_id, rows)
+
+    if len(rows) == 1:
+        reply = f"Task '{rows[0]['title']}' saved."
+    else:
+        reply = f"Saved {len(rows)} tasks: " + ", ".join(f"'{r['title']}'" for r in rows) + "."
+    if skipped:
+        reply += f" Skipped {skipped} duplicate or empty."
+    return reply
+
+
+def resolve_due(due, time_expr=None):
+    if not due:
+        return None
+    if due["type"] == "relative":
+        # The LLM is only asked when the local parser can't map the text
+        if time_expr is None:
+            time_expr = parse_time_expression(due["value"])
+        if time_expr is None:
+            time_expr = date_prompt(due["value"])["time_expression"]
+        due_date = resolve_time_expression(time_expr, date.today())
+        return due_date.isoformat() if due_date else None
+    if due["type"] == "absolute":
+        return normalize_due_date(due["value"])
+    return None
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Content-addressed cache for raw LLM responses.
+# Key is a hash of the full request payload (model, messages, options),
+# so any change in prompt or context is a different entry.
+
+CACHE_SIZE = int(os.getenv("TASKBOT_LLM_CACHE_SIZE", "512"))
+CACHE_TTL = float(os.getenv("TASKBOT_LLM_CACHE_TTL", "3600"))
+# Optional second tier on disk, empty disables it
+CACHE_DB_PATH = os.getenv("TASKBOT_LLM_CACHE_PATH", "")
+
+_lock = threading.Lock()
+_memory = OrderedDict()  # key -> (expires_at, raw)
+_disk = None
+_stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+
+def cache_key(payload: dict) -> str:
+    blob = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _get_disk():
+    global _disk
+    if not CACHE_DB_PATH:
+        return None
+    if _disk is None:
+        _disk = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False)
+        _disk.execute("PRAGMA journal_mode = WAL;")
+        _disk.execute("""CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            raw TEXT NOT NULL,
+            expires_at REAL NOT NULL
+            );
+        """)
+    return _disk
+
+
+def _remember(key, raw, expires_at):
+    _memory[key] = (expires_at, raw)
+    _memory.move_to_end(key)
+    while len(_memory) > CACHE_SIZE:
+        _memory.popitem(last=False)
+        _stats["evictions"] += 1
+
+
+def cache_get(key: str) -> str | None:
+    now = time.time()
+    with _lock:
+        entry = _memory.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                _memory.move_to_end(key)
+                _stats["hits"] += 1
+                return entry[1]
+            del _memory[key]
+
+        disk = _get_disk()
+        if disk is not None:
+            row = disk.execute(
+                "SELECT raw, expires_at FROM llm_cache WHERE key = ? AND expires_at > ?",
+                (key, now)
+            ).fetchone()
+            if row:
+                _remember(key, row[0], row[1])
+                _stats["disk_hits"] += 1
+                return row[0]
+
+        _stats["misses"] += 1
+        return None
+
+
+def cache_put(key: str, raw: str, ttl: float | None = None):
+    expires_at = time.time() + (CACHE_TTL if ttl is None else ttl)
+    with _lock:
+        _remember(key, raw, expires_at)
+        _stats["stores"] += 1
+
+        disk = _get_disk()
+        if disk is not None:
+            with disk:
+                disk.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, raw, expires_at) VALUES (?, ?, ?)",
+                    (key, raw, expires_at)
+                )
+
+
+def cache_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+        stats["size"] = len(_memory)
+    lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+    stats["hit_rate"] = (stats["hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+    return stats
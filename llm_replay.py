@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+import time
+
+from llm_cache import cache_key
+
+# Record / replay of LLM traffic as JSONL.
+#   TASKBOT_LLM_MODE=record  every request is still sent, and payload, response and timing are appended
+#   TASKBOT_LLM_MODE=replay  responses come from the file, no model needed
+# Replay builds a key -> byte offset index on first use, so lookups are one seek.
+# The exact key covers the whole payload, including volatile context (date, task list),
+# so a miss falls back to the latest record for the same stage and user message.
+
+LLM_MODE = os.getenv("TASKBOT_LLM_MODE", "live")
+RECORD_PATH = os.getenv("TASKBOT_LLM_RECORD_PATH", "requests.jsonl")
+
+_lock = threading.Lock()
+_offsets = None  # key -> offset of the latest record with that key
+_loose_offsets = None  # (stage, user message) -> offset
+_stats = {"recorded": 0, "replayed": 0, "replay_misses": 0}
+
+
+class ReplayMiss(LookupError):
+    pass
+
+
+def record_exchange(payload, response, seconds, stage=None):
+    line = json.dumps({
+        "key": cache_key(payload),
+        "stage": stage,
+        "ts": time.time(),
+        "seconds": seconds,
+        "payload": payload,
+        "response": response,
+    }, ensure_ascii=False)
+    with _lock:
+        with open(RECORD_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+        _stats["recorded"] += 1
+
+
+def _user_message(payload):
+    return next((m["content"] for m in reversed(payload["messages"]) if m["role"] == "user"), "")
+
+
+def _build_index():
+    offsets, loose = {}, {}
+    if not os.path.exists(RECORD_PATH):
+        return offsets, loose
+    with open(RECORD_PATH, "rb") as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                    offsets[record["key"]] = offset
+                    loose[(record["stage"], _user_message(record["payload"]))] = offset
+                except (ValueError, KeyError, TypeError):
+                    pass  # not a recorded exchange
+            offset += len(line)
+    return offsets, loose
+
+
+def replay_exchange(payload, stage=None):
+    global _offsets, _loose_offsets
+    key = cache_key(payload)
+    with _lock:
+        if _offsets is None:
+            _offsets, _loose_offsets = _build_index()
+        offset = _offsets.get(key)
+        if offset is None:
+            offset = _loose_offsets.get((stage, _user_message(payload)))
+        if offset is None:
+            _stats["replay_misses"] += 1
+            raise ReplayMiss(f"No recorded response for payload {key}")
+        with open(RECORD_PATH, "rb") as f:
+            f.seek(offset)
+            record = json.loads(f.readline())
+        _stats["replayed"] += 1
+    return record["response"]
+
+
+def replay_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["indexed"] = len(_offsets) if _offsets is not None else 0
+    return stats
@@ -1,18 +1,32 @@
-from flask import Flask, request, render_template
-from flask_cors import CORS
 from dotenv import load_dotenv
+
+# Before any app import, the modules read their TASKBOT_* settings at import time
+load_dotenv()
+
+from flask import Flask, request, render_template, Response
+from flask_cors import CORS
 import requests
 import os
 # APP functions
-from database import init_db, get_or_create_user
+from database import init_db, get_or_create_user, read_cache_stats
+from reminders import start_reminders, reminder_stats
+# Metrics
+import metrics
+from llm_cache import cache_stats
+from llm_replay import replay_stats
+from classifier import intent_stats
+from category_index import category_index_stats
+from task_index import task_index_stats
+from state_store import state_store_stats
 # Managing input
 from handlers.chat import chat_prompt
 
 # Telegram
 from telegram.webhook import telegram_webhook
+from telegram.updates import update_stats
+from telegram.sender import send_stats
 
 # ENV VARIABLES
-load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TASKBOT_TELEGRAM_TOKEN")
 TELEGRAM_API = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
 FLASK_KEY = os.getenv("TASKBOT_FLASK_SECRET_KEY")
@@ -24,6 +38,7 @@ CORS(app)
 
 # CREATE DATABASE ON FIRST RUN
 init_db()
+start_reminders()
 
 
 @app.route('/')
@@ -36,6 +51,24 @@ def telegram_route():
     return telegram_webhook()
 
 
+@app.route("/metrics")
+def metrics_route():
+    lines = metrics.render()
+    lines += metrics.render_stats("taskbot_llm_response_cache", cache_stats(), gauges={"size", "hit_rate"})
+    lines += metrics.render_stats("taskbot_llm_replay", replay_stats(), gauges={"indexed"})
+    lines += metrics.render_stats("taskbot_intent", intent_stats(), gauges={"rules_ratio"})
+    lines += metrics.render_stats("taskbot_read_cache", read_cache_stats(), gauges={"users", "hit_rate"})
+    lines += metrics.render_stats("taskbot_category_index", category_index_stats(), gauges={"users"})
+    lines += metrics.render_stats("taskbot_task_index", task_index_stats(), gauges={"users"})
+    lines += metrics.render_stats("taskbot_state_store", state_store_stats(), gauges={"active", "dirty"})
+    lines += metrics.render_stats("taskbot_reminders", reminder_stats(), gauges={"loaded", "scheduled", "heap"})
+    lines += metrics.render_stats("taskbot_updates", update_stats(), gauges={"max_depth", "queue_depth", "workers"})
+    lines += metrics.render_stats(
+        "taskbot_telegram_send", send_stats(), gauges={"chat_buckets", "latency_seconds_max", "latency_seconds_avg"}
+    )
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/prompt', methods=['GET'])
 def prompt():
 
@@ -0,0 +1,108 @@
+import functools
+import threading
+import time
+
+# In-process counters and histograms, rendered in the Prometheus text format
+# by the /metrics route. No dependencies so every module can import it.
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_counters = {}  # name -> {labels: value}
+_histograms = {}  # name -> {labels: [bucket counts..., sum, count]}
+_buckets = {}  # name -> bucket bounds
+_help = {}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def describe(name, text, buckets=None):
+    _help[name] = text
+    if buckets is not None:
+        _buckets[name] = tuple(buckets)
+
+
+def inc(name, value=1, **labels):
+    key = _labels_key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    bounds = _buckets.get(name, DEFAULT_BUCKETS)
+    key = _labels_key(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        row = series.get(key)
+        if row is None:
+            row = series[key] = [0] * (len(bounds) + 2)
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+
+def timed(name, **labels):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+def _format_labels(key, extra=None):
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+# Flattens a *_stats() dict, e.g. prefix "taskbot_read_cache" + {"hits": 3} renders the
+# counter taskbot_read_cache_hits_total. The stats dicts are mostly running totals,
+# keys listed in gauges (sizes, depths, ratios) are rendered as gauges instead.
+def render_stats(prefix, stats, gauges=()):
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        if key in gauges:
+            name, kind = f"{prefix}_{key}", "gauge"
+        else:
+            name, kind = f"{prefix}_{key.removesuffix('_total')}_total", "counter"
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {value}")
+    return lines
+
+
+def render():
+    lines = []
+    with _lock:
+        for name, series in sorted(_counters.items()):
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{_format_labels(key)} {value}")
+
+        for name, series in sorted(_histograms.items()):
+            bounds = _buckets.get(name, DEFAULT_BUCKETS)
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, row in sorted(series.items()):
+                for bound, count in zip(bounds, row):
+                    lines.append(f"{name}_bucket{_format_labels(key, ('le', bound))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(key, ('le', '+Inf'))} {row[-1]}")
+                lines.append(f"{name}_sum{_format_labels(key)} {row[-2]}")
+                lines.append(f"{name}_count{_format_labels(key)} {row[-1]}")
+    return lines
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+import requests
+
+import metrics
+from stages import stage_deadline
+
+# Which Ollama model serves which prompt stage, and how hard each model may be used.
+# All settings are "key=value,..." lists, e.g.
+#   TASKBOT_MODEL_ROUTES=decision_prompt=gemma3:1b,date_prompt=gemma3:1b,chat_prompt=gemma3:12b
+#   TASKBOT_MODEL_CONCURRENCY=gemma3:12b=1,gemma3:1b=8
+#   TASKBOT_MODEL_TIMEOUTS=gemma3:12b=120
+#   TASKBOT_MODEL_FALLBACKS=gemma3:12b=gemma3:latest
+# Each model has its own semaphore, so a slow model only queues its own stages.
+# A timeout, connection error, HTTP error or a full queue moves the call to the
+# model's fallback (one hop, no chains). A model's timeout covers waiting for its
+# slot and the request together. Inside run_stages the primary and the fallback
+# also share the stage's deadline.
+
+
+def _pairs(name, default=""):
+    return dict(
+        pair.strip().split("=", 1) for pair in os.getenv(name, default).split(",") if "=" in pair
+    )
+
+
+DEFAULT_MODEL = os.getenv("TASKBOT_MODEL_DEFAULT", "gemma3:latest")
+MODEL_ROUTES = _pairs("TASKBOT_MODEL_ROUTES")
+MODEL_CONCURRENCY = {k: int(v) for k, v in _pairs("TASKBOT_MODEL_CONCURRENCY").items()}
+MODEL_TIMEOUTS = {k: float(v) for k, v in _pairs("TASKBOT_MODEL_TIMEOUTS").items()}
+MODEL_FALLBACKS = _pairs("TASKBOT_MODEL_FALLBACKS")
+DEFAULT_CONCURRENCY = int(os.getenv("TASKBOT_MODEL_DEFAULT_CONCURRENCY", "4"))
+DEFAULT_TIMEOUT = float(os.getenv("TASKBOT_MODEL_DEFAULT_TIMEOUT", "60"))
+
+# Stages without a route of their own use their sibling's
+STAGE_ROUTE_ALIASES = {
+    "chat_stream_prompt": "chat_prompt",
+    "create_tasks_prompt": "create_task_prompt",
+}
+
+_lock = threading.Lock()
+_semaphores = {}
+
+metrics.describe("taskbot_model_fallbacks_total", "Calls moved to the fallback model, by reason")
+metrics.describe("taskbot_model_busy_total", "Calls that found the model's concurrency limit full until the timeout")
+
+
+# Not a TimeoutError, run_stages would take it for the stage's own deadline
+class ModelBusy(Exception):
+    pass
+
+
+FALLBACK_ERRORS = (ModelBusy, requests.Timeout, requests.ConnectionError, requests.HTTPError)
+
+
+def model_for(stage):
+    if stage in MODEL_ROUTES:
+        return MODEL_ROUTES[stage]
+    return MODEL_ROUTES.get(STAGE_ROUTE_ALIASES.get(stage), DEFAULT_MODEL)
+
+
+def timeout_for(model):
+    return MODEL_TIMEOUTS.get(model, DEFAULT_TIMEOUT)
+
+
+def _semaphore(model):
+    with _lock:
+        sem = _semaphores.get(model)
+        if sem is None:
+            sem = _semaphores[model] = threading.BoundedSemaphore(MODEL_CONCURRENCY.get(model, DEFAULT_CONCURRENCY))
+        return sem
+
+
+def acquire_slot(model, timeout):
+    if timeout <= 0 or not _semaphore(model).acquire(timeout=timeout):
+        metrics.inc("taskbot_model_busy_total", model=model)
+        raise ModelBusy(f"No free slot for {model} within {max(timeout, 0):.1f}s")
+
+
+def release_slot(model):
+    _semaphore(model).release()
+
+
+# Seconds candidates[i] may spend on its slot and request. With a stage deadline the
+# time left is shared out by model timeout, so the fallback still gets its part.
+def _budget(candidates, i, deadline):
+    own = timeout_for(candidates[i])
+    if deadline is None:
+        return own
+    rest = sum(timeout_for(c) for c in candidates[i:])
+    return max(0.0, min(own, (deadline - time.monotonic()) * own / rest))
+
+
+# Runs call(model, timeout) on the stage's model, then on its fallback if that fails.
+# Returns (model, result). With keep_slot the caller releases the slot of the returned
+# model itself, for streamed responses that are read after this returns.
+def run_routed(stage, call, model=None, keep_slot=False):
+    primary = model or model_for(stage)
+    fallback = MODEL_FALLBACKS.get(primary)
+    candidates = [primary] + ([fallback] if fallback and fallback != primary else [])
+    deadline = stage_deadline()
+
+    for i, candidate in enumerate(candidates):
+        try:
+            ends = time.monotonic() + _budget(candidates, i, deadline)
+            acquire_slot(candidate, ends - time.monotonic())
+            try:
+                remaining = ends - time.monotonic()
+                if remaining <= 0:
+                    raise ModelBusy(f"No time left for {candidate} after waiting for its slot")
+                result = call(candidate, remaining)
+            except BaseException:
+                release_slot(candidate)
+                raise
+            if not keep_slot:
+                release_slot(candidate)
+            return candidate, result
+        except FALLBACK_ERRORS as e:
+            if i == len(candidates) - 1:
+                raise
+            print(f"DEBUG: {candidate} failed for {stage}, falling back to {candidates[i + 1]}:", e)
+            metrics.inc(
+                "taskbot_model_fallbacks_total",
+                stage=stage, model=candidate, fallback=candidates[i + 1], reason=type(e).__name__
+            )
+
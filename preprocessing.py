@@ -3,9 +3,67 @@ from datetime import datetime
 import re
 import json
 
+import metrics
+
 from datetime import date, timedelta
+from functools import lru_cache
 from dateutil.relativedelta import relativedelta
 
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+NUMBER_WORDS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10, "eleven": 11,
+    "twelve": 12, "couple of": 2, "a couple of": 2,
+}
+
+_NUMBER = r"(\d+|" + "|".join(sorted(map(re.escape, NUMBER_WORDS), key=len, reverse=True)) + r")"
+_WEEKDAY = r"(" + "|".join(WEEKDAYS) + r")"
+
+# Checked in order, the first match wins, so specific phrases go before general ones
+TIME_PATTERNS = [
+    (re.compile(r"\bday after tomorrow\b"), lambda m: "in_2_days"),
+    (re.compile(r"\b(today|tonight|this evening)\b"), lambda m: "today"),
+    (re.compile(r"\btomorrow\b"), lambda m: "tomorrow"),
+    (re.compile(r"\b(?:start|beginning) of next week\b"), lambda m: "start_of_next_week"),
+    (re.compile(r"\bend of next week\b"), lambda m: "end_of_next_week"),
+    (re.compile(r"\bend of (?:the |this )?week\b"), lambda m: "end_of_week"),
+    (re.compile(r"\b(?:start|beginning) of (?:the |this )?month\b"), lambda m: "start_of_month"),
+    (re.compile(r"\bend of (?:the |this )?month\b"), lambda m: "end_of_month"),
+    (re.compile(r"\bnext " + _WEEKDAY + r"\b"), lambda m: f"next_{m.group(1)}"),
+    (re.compile(r"\bnext (week|month|year)\b"), lambda m: f"next_{m.group(1)}"),
+    (re.compile(r"\bin " + _NUMBER + r" (day|week|month|year)s?\b"),
+     lambda m: f"in_{_to_number(m.group(1))}_{m.group(2)}s"),
+    (re.compile(r"^" + _NUMBER + r" (day|week|month|year)s?(?: from now| later)?$"),
+     lambda m: f"in_{_to_number(m.group(1))}_{m.group(2)}s"),
+    # A past weekday has no place in the grammar, the LLM decides what it means
+    (re.compile(r"\b(?:last|past|previous) " + _WEEKDAY + r"\b"), lambda m: None),
+    (re.compile(r"\b(?:on |this |by )?" + _WEEKDAY + r"\b"), lambda m: m.group(1)),
+]
+
+
+def _to_number(token: str) -> int:
+    if token.isdigit():
+        return int(token)
+    return NUMBER_WORDS[token]
+
+
+# Maps free text onto the resolve_time_expression grammar, None when unsure
+@lru_cache(maxsize=1024)
+def parse_time_expression(text: str | None) -> str | None:
+    if not text:
+        return None
+
+    t = " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+    for pattern, build in TIME_PATTERNS:
+        m = pattern.search(t)
+        if m:
+            return build(m)
+    return None
+
+
+# Pure in (expr, today), so results for the current day are memoized
+@lru_cache(maxsize=1024)
 def resolve_time_expression(expr: str | None, today: date) -> date | None:
     if not expr:
         return None
@@ -39,6 +97,8 @@ def resolve_time_expression(expr: str | None, today: date) -> date | None:
             return today + timedelta(weeks=n)
         if unit == "months":
             return today + relativedelta(months=n)
+        if unit == "years":
+            return today + relativedelta(years=n)
 
     if expr == "start_of_next_week":
         return today + relativedelta(weeks=1, weekday=0)
@@ -47,6 +107,17 @@ def resolve_time_expression(expr: str | None, today: date) -> date | None:
         start = today + relativedelta(weeks=1, weekday=0)
         return start + timedelta(days=6)
 
+    if expr == "end_of_week":
+        return today + relativedelta(weekday=6)
+
+    # "friday" is the upcoming one, "next_friday" is the one in next week
+    if expr in WEEKDAYS:
+        return today + relativedelta(days=1, weekday=WEEKDAYS.index(expr))
+
+    if expr.startswith("next_") and expr[5:] in WEEKDAYS:
+        start = today + relativedelta(days=1, weekday=0)
+        return start + timedelta(days=WEEKDAYS.index(expr[5:]))
+
     if expr == "start_of_month":
         return today.replace(day=1)
 
@@ -86,9 +157,32 @@ def serialize_date(d: date | None) -> str | None:
 def fix_json(raw):
     # Remove ```json ... ``` or ``` ... ```
     cleaned = re.sub(r"```(?:json)?\n(.*?)```", r"\1", raw, flags=re.DOTALL)
-    data = json.loads(cleaned)
+    try:
+        data = json.loads(cleaned)
+    except json.JSONDecodeError:
+        metrics.inc("taskbot_json_parse_failures_total")
+        raise
     return data
 
+
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+
+# fix_json plus the cheap repairs for what small models get wrong:
+# text around the object and trailing commas. Returns (data, repaired).
+def repair_json(raw):
+    try:
+        return fix_json(raw), False
+    except json.JSONDecodeError as e:
+        error = e
+    start, end = raw.find("{"), raw.rfind("}")
+    if start != -1 and end > start:
+        try:
+            return json.loads(_TRAILING_COMMA_RE.sub(r"\1", raw[start:end + 1])), True
+        except json.JSONDecodeError:
+            pass
+    raise error
+
 # Saving on tokens for unused/less useful data
 def format_tasks(tasks, categories_by_id=None):
     if categories_by_id:
@@ -154,3 +248,64 @@ def format_categories_text(categories):
         return "No categories."
 
     return " \n ".join([f"Category {c['id']}: {c['name']}" for c in categories])
+
+
+# Rough token count, ~4 characters per token for the small models we run
+def estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+def _words(text):
+    return {w for w in re.findall(r"\w+", text.lower()) if len(w) > 2}
+
+
+# Ranks tasks by word overlap with the user text, then by nearest due date
+# (undated last), and keeps as many as fit in the token budget.
+# Returns (text, stats) where stats says how much was left out.
+def format_tasks_budgeted(tasks, user_text, budget, categories_by_id=None):
+    if not tasks:
+        return "No tasks.", {"total": 0, "shown": 0, "omitted": 0, "tokens": 0}
+
+    query = _words(user_text or "")
+    ranked = sorted(
+        range(len(tasks)),
+        key=lambda i: (
+            -len(query & _words(tasks[i]["title"])),
+            tasks[i]["due_at"] is None,
+            tasks[i]["due_at"] or "",
+            i,
+        )
+    )
+
+    # Compact line format: id|title|due|category
+    lines = {}
+    used = 0
+    for i in ranked:
+        t = tasks[i]
+        parts = [str(t["id"]), t["title"], t["due_at"] or "-"]
+        if categories_by_id and t["category_id"]:
+            parts.append(categories_by_id.get(t["category_id"]) or "-")
+        line = "|".join(parts)
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            break
+        lines[i] = line
+        used += cost
+
+    omitted = len(tasks) - len(lines)
+    text = "\n".join(lines[i] for i in sorted(lines))
+    if omitted:
+        text += f"\n(+{omitted} more tasks not shown)"
+
+    return text, {"total": len(tasks), "shown": len(lines), "omitted": omitted, "tokens": used}
+
+
+_ITEM_SPLIT_RE = re.compile(r"[,;\n]")
+_ITEM_BULLET_RE = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s*")
+
+
+# Splits "buy milk, call mom tomorrow; pay rent friday" or a bulleted list into its items.
+# Only used to route a message to the list extraction, the LLM decides what the items are.
+def split_items(text: str) -> list[str]:
+    items = (_ITEM_BULLET_RE.sub("", part).strip() for part in _ITEM_SPLIT_RE.split(text or ""))
+    return [item for item in items if item.strip(" .")]
@@ -1,58 +1,251 @@
+from dotenv import load_dotenv
+
+# Before the local imports, they read their TASKBOT_* settings at import time
+load_dotenv()
+
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import re
 import datetime
 from database import get_pending_tasks, get_categories
 from preprocessing import *
+from llm_cache import cache_key, cache_get, cache_put
+from llm_replay import LLM_MODE, record_exchange, replay_exchange
+import metrics
+import time
+from category_index import match_category
+from task_index import resolve_task
+from model_routing import model_for, run_routed, release_slot
+from schemas import STAGE_SCHEMAS, InvalidResponse, validate
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
 
 endpoint = os.getenv("TASKBOT_PROMPT_ENDPOINT")
 
-current_date = date.today().strftime("%A %d-%m-%Y")
+# Ollama keeps a model loaded this long after a request (its default is 5m, so a quiet
+# bot would reload the model and re-evaluate every prompt). Per-model overrides as
+# "model=duration,...", a negative number keeps the model loaded indefinitely.
+KEEP_ALIVE = os.getenv("TASKBOT_OLLAMA_KEEP_ALIVE", "30m")
+KEEP_ALIVE_MODELS = dict(
+    pair.split("=", 1) for pair in os.getenv("TASKBOT_OLLAMA_KEEP_ALIVE_MODELS", "").split(",") if "=" in pair
+)
+
+# Stages whose responses may be served from llm_cache. chat_prompt is volatile and stays out.
+CACHED_STAGES = set(
+    os.getenv(
+        "TASKBOT_LLM_CACHE_STAGES",
+        "decision_prompt,create_task_prompt,create_tasks_prompt,assign_category_prompt,date_prompt,fused_prompt"
+    ).split(",")
+)
+
+# Extra model calls allowed when a response doesn't parse or doesn't match the stage schema
+LLM_RETRIES = int(os.getenv("TASKBOT_LLM_RETRIES", "1"))
+
+# "staged": decision -> create_task + assign_category -> date, one LLM call per stage
+# "fused": one structured call for all of it, staged pipeline only as a fallback
+PIPELINE_MODE = os.getenv("TASKBOT_PIPELINE_MODE", "staged")
+
+# Max estimated tokens spent on the task list in a system message
+CONTEXT_TOKEN_BUDGET = int(os.getenv("TASKBOT_CONTEXT_TOKEN_BUDGET", "1500"))
+TASKS_FORMAT = "one task per line: id|title|due date or -|category"
+
+# Keep-alive connections to the model server, shared by all stages
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_maxsize=32))
+session.mount("https://", HTTPAdapter(pool_maxsize=32))
+
+
+metrics.describe("taskbot_prompt_seconds", "Prompt stage latency, source is llm or cache")
+metrics.describe("taskbot_prompt_first_token_seconds", "Time to first streamed token")
+metrics.describe("taskbot_llm_prompt_tokens_total", "Prompt tokens evaluated by the model (prompt_eval_count)")
+metrics.describe("taskbot_llm_completion_tokens_total", "Tokens generated by the model (eval_count)")
+metrics.describe("taskbot_llm_cache_hits_total", "Prompt stage responses served from llm_cache")
+metrics.describe("taskbot_llm_responses_total", "Structured responses by outcome: valid, repaired, invalid")
+metrics.describe("taskbot_llm_retries_total", "Model calls repeated because the response was invalid")
+metrics.describe("taskbot_llm_failures_total", "Prompt stage calls that had no valid response after retries")
+
 
-def prompt_ai(user_prompt, system_prompt, context = None, model="gemma3:latest"):
+def keep_alive_for(model):
+    value = KEEP_ALIVE_MODELS.get(model, KEEP_ALIVE)
+    # Ollama reads bare numbers as seconds, but only when they are JSON numbers
+    return int(value) if value.lstrip("-").isdigit() else value
 
-    system_message = system_prompt
+
+def today_text():
+    return date.today().strftime("%A %d-%m-%Y")
+
+
+# The stage instructions go first and alone, byte-for-byte the same on every call,
+# so Ollama can reuse the evaluated prefix instead of re-reading the rule block.
+# Everything that changes between calls (date, tasks, categories) follows in its own message.
+def build_messages(system_prompt, context, user_prompt):
+    messages = [{"role": "system", "content": system_prompt}]
 
     if context is not None:
-        system_message += (
-            "\n\nContext (JSON):\n"
-            + json.dumps(
+        messages.append({
+            "role": "system",
+            "content": "Context (JSON):\n" + json.dumps(
                 context if context else {"note": "No additional context provided"},
-                indent=2
+                separators=(",", ":"),
+                ensure_ascii=False
             )
-        )
+        })
+
+    messages.append({"role": "user", "content": user_prompt})
+    return messages
 
-    print(system_message)  # final system message
 
+# schema goes to Ollama's "format", which constrains decoding to that JSON shape
+def build_payload(messages, model, stream=False, schema=None):
     payload = {
         "model": model,
-        "messages": [
-            {
-                "role": "system",
-                "content": system_message
-            },
-            {"role": "user", "content": user_prompt}
-        ],
-        "stream": False,
-        "think": False
+        "messages": messages,
+        "stream": stream,
+        "think": False,
+        "keep_alive": keep_alive_for(model)
     }
+    if schema is not None:
+        payload["format"] = schema
+    return payload
+
+
+# Parses and checks a structured response, InvalidResponse when it can't be used as is
+def parse_response(raw, schema, stage):
+    try:
+        data, repaired = repair_json(raw)
+    except ValueError as e:
+        raise InvalidResponse(f"not JSON: {e}") from e
+    if schema is not None:
+        validate(data, schema)
+    metrics.inc("taskbot_llm_responses_total", stage=stage, outcome="repaired" if repaired else "valid")
+    return data
 
-    res = requests.post(
-        endpoint,
-        json=payload,
-        timeout=60
-    )
 
-    res.raise_for_status()
-    raw = res.json()["message"]["content"]
-    print(raw) # for debugging
-    llm_json = fix_json(raw) # Fixing json in a Markdown code block quotes
+# model overrides the stage's route from model_routing.
+# default is returned instead of raising InvalidResponse when no valid response came back.
+def prompt_ai(user_prompt, system_prompt, context = None, model=None, stage=None, default=None):
+
+    messages = build_messages(system_prompt, context, user_prompt)
+
+    print(messages[1:-1])  # volatile context, the instructions are fixed per stage
+
+    model = model or model_for(stage)
+    schema = STAGE_SCHEMAS.get(stage)
+    payload = build_payload(messages, model, schema=schema)
+
+    started = time.perf_counter()
+    key = cache_key(payload) if stage in CACHED_STAGES else None
+    cached = cache_get(key) if key else None
+    if cached is not None:
+        metrics.inc("taskbot_llm_cache_hits_total", stage=stage)
+        metrics.observe("taskbot_prompt_seconds", time.perf_counter() - started, stage=stage, source="cache")
+        return fix_json(cached)
+
+    # Recorded traffic only has the first attempt, so replay doesn't retry
+    retries = 0 if LLM_MODE == "replay" else LLM_RETRIES
+    for attempt in range(retries + 1):
+        if LLM_MODE == "replay":
+            body = replay_exchange(payload, stage)
+            used = model
+        else:
+            def call(candidate, timeout):
+                res = session.post(
+                    endpoint,
+                    json=build_payload(messages, candidate, schema=schema),
+                    timeout=timeout
+                )
+                res.raise_for_status()
+                return res.json()
+
+            used, body = run_routed(stage, call, model)
+            if LLM_MODE == "record":
+                record_exchange(build_payload(messages, used, schema=schema), body, time.perf_counter() - started, stage)
+        metrics.inc("taskbot_llm_prompt_tokens_total", body.get("prompt_eval_count", 0), stage=stage, model=used)
+        metrics.inc("taskbot_llm_completion_tokens_total", body.get("eval_count", 0), stage=stage, model=used)
+        raw = body["message"]["content"]
+        print(raw) # for debugging
+        try:
+            llm_json = parse_response(raw, schema, stage)
+            break
+        except InvalidResponse as e:
+            metrics.inc("taskbot_llm_responses_total", stage=stage, outcome="invalid")
+            if attempt == retries:
+                metrics.inc("taskbot_llm_failures_total", stage=stage)
+                metrics.observe("taskbot_prompt_seconds", time.perf_counter() - started, stage=stage, source="llm")
+                if default is not None:
+                    print(f"DEBUG: no valid {stage} response, using default:", e)
+                    return default
+                raise
+            print(f"DEBUG: invalid {stage} response, retrying:", e)
+            metrics.inc("taskbot_llm_retries_total", stage=stage)
+            # Showing the model its own answer and the problem is cheaper than starting over
+            messages = messages + [
+                {"role": "assistant", "content": raw},
+                {"role": "user", "content": f"That response was invalid ({e}). Reply with only the corrected JSON object."},
+            ]
+
+    metrics.observe("taskbot_prompt_seconds", time.perf_counter() - started, stage=stage, source="llm")
+    if key and used == model:
+        # Only responses that validated are worth replaying, and fallback answers only for this call
+        cache_put(key, json.dumps(llm_json, ensure_ascii=False))
     return llm_json
 
 
+# Yields the reply piece by piece as Ollama generates it (plain text, no JSON repair).
+# The model's concurrency slot is held until the stream is finished or abandoned.
+def stream_prompt_ai(user_prompt, system_prompt, context=None, model=None, stage=None):
+    messages = build_messages(system_prompt, context, user_prompt)
+    model = model or model_for(stage)
+
+    started = time.perf_counter()
+    if LLM_MODE == "replay":
+        yield replay_exchange(build_payload(messages, model, stream=True), stage)["message"]["content"]
+        return
+
+    def call(candidate, timeout):
+        res = session.post(endpoint, json=build_payload(messages, candidate, stream=True), timeout=timeout, stream=True)
+        try:
+            res.raise_for_status()
+        except Exception:
+            res.close()
+            raise
+        return res
+
+    # Fallback is only possible until the response starts, a failure mid-stream propagates
+    model, res = run_routed(stage, call, model, keep_slot=True)
+    payload = build_payload(messages, model, stream=True)
+
+    first = True
+    pieces = []
+    try:
+        with res:
+            for line in res.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                piece = chunk.get("message", {}).get("content", "")
+                if piece:
+                    if first:
+                        metrics.observe("taskbot_prompt_first_token_seconds", time.perf_counter() - started, stage=stage)
+                        first = False
+                    pieces.append(piece)
+                    yield piece
+                if chunk.get("done"):
+                    if LLM_MODE == "record":
+                        record_exchange(
+                            payload,
+                            dict(chunk, message={"role": "assistant", "content": "".join(pieces)}),
+                            time.perf_counter() - started,
+                            stage
+                        )
+                    metrics.inc("taskbot_llm_prompt_tokens_total", chunk.get("prompt_eval_count", 0), stage=stage, model=model)
+                    metrics.inc("taskbot_llm_completion_tokens_total", chunk.get("eval_count", 0), stage=stage, model=model)
+                    break
+    finally:
+        release_slot(model)
+    metrics.observe("taskbot_prompt_seconds", time.perf_counter() - started, stage=stage, source="llm")
+
+
 def decision_prompt(user_prompt):
     system_prompt = """
 You are an intent classifier.
@@ -80,7 +273,9 @@ Rules:
     return prompt_ai(
         user_prompt=user_prompt,
         system_prompt=system_prompt,
-        context={}
+        context={},
+        stage="decision_prompt",
+        default={"type": "chat"}
     )
 
 
@@ -122,10 +317,63 @@ Output ONLY the JSON object.
 """
 
     context = {
-        "current_date": current_date
+        "current_date": today_text()
+    }
+
+    return prompt_ai(user_prompt, system_prompt, context, stage="create_task_prompt",
+                     default={"title": None, "due": None})
+
+
+# Several tasks in one message, extracted in one call instead of one pipeline run per task
+def create_tasks_prompt(user_prompt):
+    system_prompt = """You extract a list of tasks.
+
+You MUST respond with a single valid JSON object.
+Do NOT use Markdown, code blocks, or explanations.
+
+Schema:
+{
+  "tasks": [
+    {
+      "title": string,
+      "due": null | {
+        "type": "absolute" | "relative",
+        "value": string
+      }
+    }
+  ]
+}
+
+Rules:
+- One entry per separate action, in the order they are mentioned
+- Items of one action stay one task ("buy milk, eggs and bread" is one task)
+- title is REQUIRED
+- Do NOT include category names in the title
+- Do NOT include dates in the title
+- Do NOT infer or invent information
+
+Date rules:
+- DO NOT calculate dates
+- Relative dates: return exactly as mentioned
+- Absolute dates: extract exactly
+- A date belongs only to the task it is mentioned with
+- If no date is mentioned, due must be null
+
+Examples:
+- "buy milk, call mom tomorrow"
+  -> { "tasks": [
+       { "title": "Buy milk", "due": null },
+       { "title": "Call mom", "due": { "type": "relative", "value": "tomorrow" } }
+     ] }
+
+Output ONLY the JSON object.
+"""
+
+    context = {
+        "current_date": today_text()
     }
 
-    return prompt_ai(user_prompt, system_prompt, context)
+    return prompt_ai(user_prompt, system_prompt, context, stage="create_tasks_prompt", default={"tasks": []})
 
 
 def assign_category_prompt(title: str, user_id: int):
@@ -153,6 +401,13 @@ Rules:
 """
 
     categories = get_categories(user_id)
+    if not categories:
+        return {"category_id": None, "confidence": "low"}
+
+    # Obvious matches are scored locally, the LLM only breaks close calls
+    local = match_category(user_id, title, categories)
+    if local is not None:
+        return local
 
     context = {
         "task_title": title,
@@ -166,7 +421,8 @@ Rules:
         ]
     }
 
-    return prompt_ai(title, system_prompt, context)
+    return prompt_ai(title, system_prompt, context, stage="assign_category_prompt",
+                     default={"category_id": None, "confidence": "low"})
 
 
 def mark_as_done_prompt(user_prompt,user_id):
@@ -193,18 +449,29 @@ Rules:
 
         """
 
-    tasks = format_tasks_text(get_pending_tasks(user_id))
+    # Explicit ids and clear title matches are resolved locally
+    local = resolve_task(user_id, user_prompt, lambda: get_pending_tasks(user_id))
+    if local is not None:
+        return local
+
+    tasks = get_pending_tasks(user_id)
+    tasks_text, budget_stats = format_tasks_budgeted(tasks, user_prompt, CONTEXT_TOKEN_BUDGET)
+    if budget_stats["omitted"]:
+        print("DEBUG: context truncated", budget_stats)
 
     context = {
-        "current_date": current_date,
-        "current_tasks": tasks,
+        "current_tasks_format": TASKS_FORMAT,
+        "current_tasks": tasks_text,
         "has_tasks": len(tasks) > 0,
+        "current_date": today_text(),
     }
 
     data = prompt_ai(
         user_prompt=user_prompt,
         system_prompt=system_prompt,
-        context=context
+        context=context,
+        stage="mark_as_done_prompt",
+        default={"task_id": None, "message": "I couldn't work out which task you meant."}
     )
 
     return data
@@ -236,27 +503,66 @@ If there are no tasks in the context, reply exactly:
 
 """
 
+    data = prompt_ai(
+        user_prompt=user_prompt,
+        system_prompt=system_prompt,
+        context=chat_context(user_prompt, user_id),
+        stage="chat_prompt",
+        default={"message": "Sorry, I couldn't put an answer together. Please try again."}
+    )
+
+    return data["message"]
+
+
+def chat_context(user_prompt, user_id):
     categories = get_categories(user_id)
     categories_by_id = {c["id"]: c["name"] for c in categories}
     tasks = get_pending_tasks(user_id)
+    tasks_text, budget_stats = format_tasks_budgeted(
+        tasks, user_prompt, CONTEXT_TOKEN_BUDGET, categories_by_id
+    )
+    if budget_stats["omitted"]:
+        print("DEBUG: context truncated", budget_stats)
 
-
-    context = {
-        "current_date": current_date,
-        "current_tasks": format_tasks_text(tasks, categories_by_id),
-        "has_tasks": len(tasks) > 0,
+    # Least volatile first: categories rarely change, tasks on every write, the date daily
+    return {
         "categories": format_categories_text(categories),
         "has_categories": len(categories) > 0,
+        "current_tasks_format": TASKS_FORMAT,
+        "current_tasks": tasks_text,
+        "has_tasks": len(tasks) > 0,
+        "tasks_not_shown": budget_stats["omitted"],
+        "current_date": today_text(),
     }
 
-    data = prompt_ai(
+
+# Same advisor as chat_prompt, but answers in plain text so it can be shown while generating
+def chat_stream_prompt(user_prompt, user_id):
+    system_prompt = """
+You are a task advisor. 
+You provide insight to the user based on the tasks in the context and user's questions.
+
+Respond with plain, unstyled text only. No JSON, no Markdown.
+
+Rules:
+- By default, include tasks with the nearest deadlines. Do no include task IDs. 
+- If the user requests an action (e.g. remove, delete, mark, complete):
+  - Inform the user that buttons are responsible for actions
+  - you can only chat with user about his tasks
+
+
+If there are no tasks in the context, reply exactly:
+There are no tasks created yet.
+
+"""
+
+    return stream_prompt_ai(
         user_prompt=user_prompt,
         system_prompt=system_prompt,
-        context=context
+        context=chat_context(user_prompt, user_id),
+        stage="chat_stream_prompt"
     )
 
-    return data["message"]
-
 
 def date_prompt(relative_date):
     system_prompt = """
@@ -303,15 +609,120 @@ Examples:
     data = prompt_ai(
         user_prompt=relative_date,
         system_prompt=system_prompt,
-        context=None
+        context=None,
+        stage="date_prompt",
+        default={"time_expression": None}
     )
 
     return data
 
 
+def fused_prompt(user_prompt, user_id):
+    system_prompt = """
+You extract everything needed to handle a task bot message in one step.
 
+You MUST respond with a single valid JSON object.
+Do NOT use Markdown, code blocks, or explanations.
 
+Schema:
+{
+  "type": "create_task" | "mark_as_done" | "chat",
+  "title": string | null,
+  "due": null | {
+    "type": "absolute" | "relative",
+    "value": string
+  },
+  "time_expression": string | null,
+  "category_id": number | null,
+  "confidence": "high" | "medium" | "low"
+}
 
+Intent rules:
+- Choose "create_task" ONLY if the user clearly asks to create or add something
+- Queries, single words, listings, or vague references MUST be "chat"
+- "remove / delete / mark / done" -> "mark_as_done"
+- For "mark_as_done" and "chat", title, due, time_expression and category_id MUST be null
+
+Task rules (create_task only):
+- title is REQUIRED, without dates or category names
+- due: absolute dates exactly as written, relative dates exactly as mentioned, null if none
+- time_expression: for relative dates ONLY, one of
+  today, tomorrow, next_week, next_month, next_year, in_N_days, in_N_weeks,
+  in_N_months, start_of_next_week, end_of_next_week, start_of_month, end_of_month
+  otherwise null
+- category_id: the best matching category from context, null if none clearly matches
+- confidence refers to category_id, "low" when category_id is null
 
+Examples:
+- "buy milk tomorrow" ->
+  { "type": "create_task", "title": "Buy milk", "due": { "type": "relative", "value": "tomorrow" },
+    "time_expression": "tomorrow", "category_id": null, "confidence": "low" }
+- "show tasks" ->
+  { "type": "chat", "title": null, "due": null, "time_expression": null, "category_id": null, "confidence": "low" }
+"""
+
+    categories = get_categories(user_id)
 
+    context = {
+        "categories": [
+            {
+                "id": c["id"],
+                "name": c["name"],
+                "description": c.get("description")
+            }
+            for c in categories
+        ],
+        "current_date": today_text(),
+    }
 
+    try:
+        data = prompt_ai(user_prompt, system_prompt, context, stage="fused_prompt")
+    except InvalidResponse as e:
+        print("DEBUG: fused_prompt returned an invalid response:", e)
+        return None
+    return validate_fused(data, {c["id"] for c in categories})
+
+
+TIME_EXPRESSION_RE = re.compile(
+    r"^(today|tomorrow|next_week|next_month|next_year|in_\d+_(days|weeks|months)"
+    r"|start_of_next_week|end_of_next_week|start_of_month|end_of_month)$"
+)
+
+# Returns the normalized fused extraction, or None when it doesn't match the schema
+# (the caller then falls back to the staged pipeline)
+def validate_fused(data, category_ids):
+    if not isinstance(data, dict):
+        return None
+
+    intent = data.get("type")
+    if intent not in ("create_task", "mark_as_done", "chat"):
+        return None
+    if intent != "create_task":
+        return {"type": intent}
+
+    title = data.get("title")
+    if not isinstance(title, str) or not title.strip():
+        return None
+
+    due = data.get("due")
+    if due is not None:
+        if not isinstance(due, dict) or due.get("type") not in ("absolute", "relative"):
+            return None
+        if not isinstance(due.get("value"), str) or not due["value"].strip():
+            return None
+
+    time_expr = data.get("time_expression")
+    if time_expr is not None and not (isinstance(time_expr, str) and TIME_EXPRESSION_RE.match(time_expr)):
+        time_expr = None
+
+    category_id = data.get("category_id")
+    if category_id not in category_ids or data.get("confidence") != "high":
+        category_id = None
+
+    return {
+        "type": "create_task",
+        "title": title.strip(),
+        "due": due,
+        "time_expression": time_expr,
+        "category_id": category_id,
+    }
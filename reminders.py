@@ -0,0 +1,182 @@
+import heapq
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+# Due-date reminders. Tasks due within the next REMINDER_HORIZON are kept in a
+# min-heap keyed by reminder time; the heap is refilled by one indexed range query
+# every REMINDER_RELOAD_INTERVAL and kept current by database.add_task / mark_task_done.
+# A due date without a time is reminded at REMINDER_HOUR (server local time).
+# The scheduler thread only runs in processes that call start_reminders().
+
+REMINDERS = os.getenv("TASKBOT_REMINDERS", "1") == "1"
+REMINDER_HOUR = int(os.getenv("TASKBOT_REMINDER_HOUR", "9"))
+REMINDER_HORIZON = float(os.getenv("TASKBOT_REMINDER_HORIZON", "86400"))
+REMINDER_RELOAD_INTERVAL = float(os.getenv("TASKBOT_REMINDER_RELOAD_INTERVAL", "3600"))
+# Reminders missed by more than this (e.g. the bot was down) are dropped, not sent late
+REMINDER_MAX_LATE = float(os.getenv("TASKBOT_REMINDER_MAX_LATE", "86400"))
+REMINDER_BATCH = int(os.getenv("TASKBOT_REMINDER_BATCH", "500"))
+REMINDER_SEND_WORKERS = int(os.getenv("TASKBOT_REMINDER_SEND_WORKERS", "4"))
+REMINDER_LOAD_LIMIT = 100000
+
+_lock = threading.Lock()
+_heap = []  # (remind_at, task_id)
+_scheduled = {}  # task_id -> (remind_at, user_id, title), heap entries not in here are stale
+_horizon_end = 0.0  # tasks reminded before this are in the heap, later ones come with the next reload
+_wakeup = threading.Event()
+_thread = None
+_stats = {"loads": 0, "loaded": 0, "sent": 0, "send_failures": 0, "dropped_late": 0}
+
+
+def remind_time(due_at):
+    if not due_at:
+        return None
+    try:
+        if len(due_at) == 10:
+            due = datetime.combine(date.fromisoformat(due_at), datetime.min.time()).replace(hour=REMINDER_HOUR)
+        else:
+            due = datetime.fromisoformat(due_at)
+    except ValueError:
+        return None
+    return due.timestamp()
+
+
+def is_past(due_at):
+    remind_at = remind_time(due_at)
+    return remind_at is not None and remind_at <= time.time()
+
+
+def _push(task_id, user_id, title, remind_at):
+    _scheduled[task_id] = (remind_at, user_id, title)
+    heapq.heappush(_heap, (remind_at, task_id))
+
+
+# Called by database.add_task, tasks beyond the horizon are picked up by a later reload
+def schedule_task(task_id, user_id, title, due_at):
+    if _thread is None:
+        return
+    remind_at = remind_time(due_at)
+    if remind_at is None:
+        return
+    with _lock:
+        if remind_at >= _horizon_end:
+            return
+        earliest = _heap[0][0] if _heap else None
+        _push(task_id, user_id, title, remind_at)
+    if earliest is None or remind_at < earliest:
+        _wakeup.set()
+
+
+# Called by database.mark_task_done, the heap entry is skipped when it comes up
+def unschedule_task(task_id):
+    with _lock:
+        _scheduled.pop(task_id, None)
+
+
+def _reload():
+    global _horizon_end
+    import database
+
+    now = time.time()
+    end = now + REMINDER_HORIZON
+    # Date-only due dates compare as strings, the window is widened to whole days
+    # and remind_time() filters precisely
+    start_day = date.fromtimestamp(now - REMINDER_MAX_LATE).isoformat()
+    end_day = (date.fromtimestamp(end) + timedelta(days=1)).isoformat()
+    rows = database.get_reminder_window(start_day, end_day, REMINDER_LOAD_LIMIT)
+
+    with _lock:
+        _heap.clear()
+        _scheduled.clear()
+        for row in rows:
+            remind_at = remind_time(row["due_at"])
+            if remind_at is not None and remind_at < end:
+                _push(row["id"], row["user_id"], row["title"], remind_at)
+        heapq.heapify(_heap)
+        _horizon_end = end
+        _stats["loads"] += 1
+        _stats["loaded"] = len(_scheduled)
+
+
+def _pop_due(now):
+    due = []
+    with _lock:
+        while _heap and _heap[0][0] <= now and len(due) < REMINDER_BATCH:
+            remind_at, task_id = heapq.heappop(_heap)
+            entry = _scheduled.get(task_id)
+            if entry is None or entry[0] != remind_at:
+                continue
+            del _scheduled[task_id]
+            if now - remind_at > REMINDER_MAX_LATE:
+                _stats["dropped_late"] += 1
+                continue
+            due.append((task_id, entry[2]))
+    return due
+
+
+def _send_batch(pool, due):
+    import database
+    from telegram.sender import telegram_request
+
+    titles = dict(due)
+    # One message per chat, whatever number of its tasks came due together
+    by_chat = defaultdict(list)
+    for task_id, chat_id in database.claim_reminders(list(titles)):
+        by_chat[chat_id].append(titles[task_id])
+
+    def send(item):
+        chat_id, chat_titles = item
+        if len(chat_titles) == 1:
+            text = f"⏰ Reminder: '{chat_titles[0]}' is due."
+        else:
+            text = "⏰ Reminder, these tasks are due:\n" + "\n".join(f"• {t}" for t in chat_titles)
+        return telegram_request("sendMessage", {"chat_id": chat_id, "text": text}, chat_id=chat_id)
+
+    for (chat_id, chat_titles), res in zip(by_chat.items(), pool.map(send, by_chat.items())):
+        with _lock:
+            if res:
+                _stats["sent"] += len(chat_titles)
+            else:
+                _stats["send_failures"] += len(chat_titles)
+
+
+def _run():
+    pool = ThreadPoolExecutor(max_workers=REMINDER_SEND_WORKERS, thread_name_prefix="reminder-send")
+    next_reload = 0.0
+    while True:
+        try:
+            now = time.time()
+            if now >= next_reload:
+                _reload()
+                next_reload = now + REMINDER_RELOAD_INTERVAL
+            # Cleared before looking at the heap, so a schedule_task() from now on still wakes us
+            _wakeup.clear()
+            due = _pop_due(now)
+            if due:
+                _send_batch(pool, due)
+                continue
+            with _lock:
+                wait = min(next_reload, _heap[0][0] if _heap else next_reload) - time.time()
+            _wakeup.wait(max(0.0, wait))
+        except Exception as e:
+            print("ERROR in reminder loop:", e)
+            time.sleep(5)
+
+
+def start_reminders():
+    global _thread
+    if not REMINDERS or _thread is not None:
+        return
+    _thread = threading.Thread(target=_run, name="reminders", daemon=True)
+    _thread.start()
+
+
+def reminder_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["scheduled"] = len(_scheduled)
+        stats["heap"] = len(_heap)
+    return stats
@@ -0,0 +1,138 @@
+# JSON schemas for the structured prompt stages. prompt_ai sends them as Ollama's
+# "format" so decoding is constrained to the shape, and checks every response
+# against them before a caller indexes into it. Only the subset used here is
+# supported: type (one or a list), enum, properties, required, items, anyOf.
+
+_NULLABLE_DUE = {
+    "anyOf": [
+        {"type": "null"},
+        {
+            "type": "object",
+            "properties": {
+                "type": {"type": "string", "enum": ["absolute", "relative"]},
+                "value": {"type": "string"},
+            },
+            "required": ["type", "value"],
+        },
+    ]
+}
+
+_TASK = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "due": _NULLABLE_DUE,
+    },
+    "required": ["title", "due"],
+}
+
+_CONFIDENCE = {"type": "string", "enum": ["high", "medium", "low"]}
+
+STAGE_SCHEMAS = {
+    "decision_prompt": {
+        "type": "object",
+        "properties": {"type": {"type": "string", "enum": ["create_task", "mark_as_done", "chat"]}},
+        "required": ["type"],
+    },
+    "create_task_prompt": _TASK,
+    "create_tasks_prompt": {
+        "type": "object",
+        "properties": {"tasks": {"type": "array", "items": _TASK}},
+        "required": ["tasks"],
+    },
+    "assign_category_prompt": {
+        "type": "object",
+        "properties": {
+            "category_id": {"type": ["integer", "null"]},
+            "confidence": _CONFIDENCE,
+        },
+        "required": ["category_id", "confidence"],
+    },
+    "mark_as_done_prompt": {
+        "type": "object",
+        "properties": {
+            "task_id": {"type": ["integer", "null"]},
+            "message": {"type": ["string", "null"]},
+        },
+        "required": ["task_id", "message"],
+    },
+    "chat_prompt": {
+        "type": "object",
+        "properties": {"message": {"type": "string"}},
+        "required": ["message"],
+    },
+    "date_prompt": {
+        "type": "object",
+        "properties": {"time_expression": {"type": ["string", "null"]}},
+        "required": ["time_expression"],
+    },
+    "fused_prompt": {
+        "type": "object",
+        "properties": {
+            "type": {"type": "string", "enum": ["create_task", "mark_as_done", "chat"]},
+            "title": {"type": ["string", "null"]},
+            "due": _NULLABLE_DUE,
+            "time_expression": {"type": ["string", "null"]},
+            "category_id": {"type": ["integer", "null"]},
+            "confidence": _CONFIDENCE,
+        },
+        "required": ["type", "title", "due", "time_expression", "category_id", "confidence"],
+    },
+}
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "null": type(None),
+}
+
+
+class InvalidResponse(ValueError):
+    pass
+
+
+def _is_type(value, name):
+    # bool is an int subclass, but true is not a task id
+    if isinstance(value, bool) and name in ("integer", "number"):
+        return False
+    return isinstance(value, _TYPES[name])
+
+
+def schema_errors(value, schema, path="$"):
+    if "anyOf" in schema:
+        if any(not schema_errors(value, option, path) for option in schema["anyOf"]):
+            return []
+        return [f"{path}: matches none of the allowed shapes"]
+
+    types = schema.get("type")
+    if types is not None:
+        types = [types] if isinstance(types, str) else types
+        if not any(_is_type(value, t) for t in types):
+            return [f"{path}: expected {' or '.join(types)}, got {type(value).__name__}"]
+
+    if "enum" in schema and value not in schema["enum"]:
+        return [f"{path}: {value!r} is not one of {schema['enum']}"]
+
+    errors = []
+    if isinstance(value, dict):
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{path}.{key}: missing")
+        for key, sub in schema.get("properties", {}).items():
+            if key in value:
+                errors += schema_errors(value[key], sub, f"{path}.{key}")
+    elif isinstance(value, list) and "items" in schema:
+        for i, item in enumerate(value):
+            errors += schema_errors(item, schema["items"], f"{path}[{i}]")
+    return errors
+
+
+def validate(value, schema):
+    errors = schema_errors(value, schema)
+    if errors:
+        raise InvalidResponse("; ".join(errors[:5]))
+    return value
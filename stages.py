@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+# Runs independent pipeline stages (LLM prompts, lookups) side by side.
+# Every stage gets its own deadline, stages that miss it are cancelled
+# (or abandoned if already running) and reported in the errors dict.
+
+STAGE_WORKERS = int(os.getenv("TASKBOT_STAGE_WORKERS", "8"))
+STAGE_TIMEOUT = float(os.getenv("TASKBOT_STAGE_TIMEOUT", "60"))
+
+_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="stage")
+_local = threading.local()
+
+
+class StageTimeout(Exception):
+    pass
+
+
+# stages: {name: (fn, args)} or {name: (fn, args, kwargs)}
+# timeouts: optional {name: seconds}, missing names use STAGE_TIMEOUT
+# Returns (results, errors), both keyed by stage name
+def run_stages(stages: dict, timeouts: dict | None = None) -> tuple[dict, dict]:
+    timeouts = timeouts or {}
+    started = time.monotonic()
+
+    futures = {}
+    for name, spec in stages.items():
+        fn, args = spec[0], spec[1]
+        kwargs = spec[2] if len(spec) > 2 else {}
+        deadline = started + timeouts.get(name, STAGE_TIMEOUT)
+        futures[name] = _executor.submit(_run_stage, deadline, fn, args, kwargs)
+
+    results, errors = {}, {}
+    # Wait on the shortest deadlines first so a slow stage can't hide a timeout
+    for name in sorted(futures, key=lambda n: timeouts.get(n, STAGE_TIMEOUT)):
+        future = futures[name]
+        deadline = started + timeouts.get(name, STAGE_TIMEOUT)
+        try:
+            results[name] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except TimeoutError:
+            # Since 3.11 this is the builtin TimeoutError, which the stage itself may raise.
+            # The stage may also have finished just after the wait gave up.
+            if future.done():
+                if future.exception() is not None:
+                    errors[name] = future.exception()
+                else:
+                    results[name] = future.result()
+                continue
+            future.cancel()
+            errors[name] = StageTimeout(f"{name} timed out")
+        except Exception as e:
+            errors[name] = e
+
+    return results, errors
+
+
+def _run_stage(deadline, fn, args, kwargs):
+    _local.deadline = deadline
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _local.deadline = None
+
+
+# time.monotonic() deadline of the stage running in this thread, None outside run_stages.
+# model_routing fits its slot waits and requests into it.
+def stage_deadline():
+    return getattr(_local, "deadline", None)
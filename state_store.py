@@ -0,0 +1,135 @@
+import atexit
+import copy
+import os
+import threading
+import time
+
+import database
+
+# Conversation state (creating_task drafts etc.) for handle_message.
+# TASKBOT_STATE_STORE=db (default) reads and writes user_states directly, which is
+# what several gunicorn workers need to see each other's drafts.
+# TASKBOT_STATE_STORE=memory is for single-process deployments only: states live in
+# this process, changes are written behind in batches by a background thread and
+# loaded back on startup. States untouched for STATE_TTL expire.
+
+STATE_STORE = os.getenv("TASKBOT_STATE_STORE", "db")
+STATE_TTL = float(os.getenv("TASKBOT_STATE_TTL", "3600"))
+STATE_FLUSH_INTERVAL = float(os.getenv("TASKBOT_STATE_FLUSH_INTERVAL", "2"))
+# A flush starts early once this many users have unwritten changes
+STATE_FLUSH_BATCH = int(os.getenv("TASKBOT_STATE_FLUSH_BATCH", "100"))
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()  # one writer at a time, so batches land in order
+_states = None  # user_id -> {"state", "draft", "updated_ts"}, None until loaded
+_dirty = {}  # user_id -> entry to upsert, or None to delete
+_wakeup = threading.Event()
+_flusher = None
+_stats = {"hits": 0, "misses": 0, "expired": 0, "flushes": 0, "flushed_rows": 0, "flush_errors": 0}
+
+
+def _load():
+    global _states, _flusher
+    if _states is None:
+        _states = {row["user_id"]: row for row in database.load_user_states(STATE_TTL)}
+        _flusher = threading.Thread(target=_flush_loop, name="state-flush", daemon=True)
+        _flusher.start()
+    return _states
+
+
+def _expired(entry, now):
+    return now - entry["updated_ts"] > STATE_TTL
+
+
+def get_user_state(user_id):
+    if STATE_STORE != "memory":
+        return database.get_user_state(user_id)
+    now = time.time()
+    with _lock:
+        entry = _load().get(user_id)
+        if entry is not None and _expired(entry, now):
+            del _states[user_id]
+            _dirty[user_id] = None
+            _stats["expired"] += 1
+            entry = None
+        if entry is None:
+            _stats["misses"] += 1
+            return None
+        _stats["hits"] += 1
+        # Callers mutate the draft before set_user_state, keep ours untouched
+        return {"state": entry["state"], "draft": copy.deepcopy(entry["draft"])}
+
+
+def set_user_state(user_id, state, draft=None):
+    if STATE_STORE != "memory":
+        return database.set_user_state(user_id, state, draft)
+    entry = {"user_id": user_id, "state": state, "draft": copy.deepcopy(draft or {}), "updated_ts": time.time()}
+    with _lock:
+        _load()[user_id] = entry
+        _dirty[user_id] = entry
+        if len(_dirty) >= STATE_FLUSH_BATCH:
+            _wakeup.set()
+
+
+def clear_user_state(user_id):
+    if STATE_STORE != "memory":
+        return database.clear_user_state(user_id)
+    with _lock:
+        if _load().pop(user_id, None) is not None or user_id in _dirty:
+            _dirty[user_id] = None
+
+
+def flush_states():
+    with _flush_lock:
+        with _lock:
+            if not _dirty:
+                return 0
+            batch = dict(_dirty)
+            _dirty.clear()
+        upserts = [(uid, e["state"], e["draft"], e["updated_ts"]) for uid, e in batch.items() if e is not None]
+        deletes = [uid for uid, e in batch.items() if e is None]
+        try:
+            database.write_user_states(upserts, deletes)
+        except Exception as e:
+            print("ERROR writing user states:", e)
+            with _lock:
+                # Put back whatever hasn't been changed again since
+                for uid, entry in batch.items():
+                    _dirty.setdefault(uid, entry)
+                _stats["flush_errors"] += 1
+            return 0
+        with _lock:
+            _stats["flushes"] += 1
+            _stats["flushed_rows"] += len(batch)
+        return len(batch)
+
+
+def _sweep():
+    now = time.time()
+    with _lock:
+        for user_id in [uid for uid, e in _states.items() if _expired(e, now)]:
+            del _states[user_id]
+            _dirty[user_id] = None
+            _stats["expired"] += 1
+
+
+def _flush_loop():
+    while True:
+        _wakeup.wait(STATE_FLUSH_INTERVAL)
+        _wakeup.clear()
+        try:
+            _sweep()
+            flush_states()
+        except Exception as e:
+            print("ERROR in state flush loop:", e)
+
+
+def state_store_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["active"] = len(_states) if _states is not None else 0
+        stats["dirty"] = len(_dirty)
+    return stats
+
+
+atexit.register(flush_states)
@@ -0,0 +1,155 @@
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+# Per-user trigram index over pending task titles, used by mark_as_done_prompt
+# to resolve "done with the report" or "task 12" without an LLM call.
+# database.add_task / mark_task_done keep it in sync for users already loaded,
+# everything else is (re)loaded from the pending list on demand.
+
+# A wrong match marks the wrong task done, anything less certain goes to the LLM
+TASK_MATCH_MIN_SCORE = float(os.getenv("TASKBOT_TASK_MATCH_MIN_SCORE", "0.75"))
+TASK_MATCH_MARGIN = float(os.getenv("TASKBOT_TASK_MATCH_MARGIN", "0.15"))
+TASK_INDEX_USERS = int(os.getenv("TASKBOT_TASK_INDEX_USERS", "1024"))
+# Other processes can't update this index, so it is reloaded after a while
+TASK_INDEX_TTL = float(os.getenv("TASKBOT_TASK_INDEX_TTL", "30"))
+
+# Words that say "mark as done" rather than which task
+COMMAND_WORDS = {
+    "mark", "marked", "done", "as", "with", "the", "a", "an", "my", "finished",
+    "finish", "complete", "completed", "delete", "remove", "removed", "task",
+    "i", "im", "i'm", "am", "have", "has", "is", "it", "please", "off", "tick",
+    "check", "checked", "just", "already", "that", "this",
+}
+
+_EXPLICIT_ID_RE = re.compile(r"(?:#|\btask\s*#?|\bid\s*#?)\s*(\d+)\b")
+_WORD_RE = re.compile(r"[\w']+")
+
+_indexes = OrderedDict()  # user_id -> index dict
+_lock = threading.Lock()
+_stats = {"explicit_id": 0, "fuzzy": 0, "llm_fallback": 0, "loads": 0}
+
+
+def normalize(text):
+    return " ".join(_WORD_RE.findall((text or "").lower()))
+
+
+def trigrams(text):
+    padded = f"  {normalize(text)} "
+    return Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def _new_index():
+    return {"titles": {}, "grams": {}, "postings": defaultdict(set), "loaded_at": time.monotonic()}
+
+
+def _add(index, task_id, title):
+    if task_id in index["titles"]:
+        _remove(index, task_id)
+    grams = trigrams(title)
+    index["titles"][task_id] = normalize(title)
+    index["grams"][task_id] = grams
+    for gram in grams:
+        index["postings"][gram].add(task_id)
+
+
+def _remove(index, task_id):
+    index["titles"].pop(task_id, None)
+    for gram in index["grams"].pop(task_id, ()):
+        postings = index["postings"].get(gram)
+        if postings is not None:
+            postings.discard(task_id)
+            if not postings:
+                del index["postings"][gram]
+
+
+def _get_index(user_id, load_tasks):
+    index = _indexes.get(user_id)
+    if index is None or time.monotonic() - index["loaded_at"] > TASK_INDEX_TTL:
+        index = _new_index()
+        for t in load_tasks():
+            _add(index, t["id"], t["title"])
+        _indexes[user_id] = index
+        _stats["loads"] += 1
+        while len(_indexes) > TASK_INDEX_USERS:
+            _indexes.popitem(last=False)
+    _indexes.move_to_end(user_id)
+    return index
+
+
+# Called by database.add_task, only users with a loaded index are updated
+def index_task(user_id, task_id, title):
+    with _lock:
+        index = _indexes.get(user_id)
+        if index is not None:
+            _add(index, task_id, title)
+
+
+# Called by database.mark_task_done
+def unindex_task(user_id, task_id):
+    with _lock:
+        index = _indexes.get(user_id)
+        if index is not None:
+            _remove(index, task_id)
+
+
+def _score(index, query_text):
+    query = trigrams(query_text)
+    size = sum(query.values())
+    shared = Counter()
+    for gram, count in query.items():
+        for task_id in index["postings"].get(gram, ()):
+            shared[task_id] += min(count, index["grams"][task_id][gram])
+
+    query_norm = normalize(query_text)
+    query_words = set(query_norm.split())
+    scores = {}
+    for task_id, common in shared.items():
+        # Dice coefficient on trigrams handles typos ("renew pasport"), a query whose
+        # words all appear in the title handles short references to long titles
+        # ("the report"). One shared word out of two ("call dad" vs "Call mom") is neither.
+        dice = 2 * common / (size + sum(index["grams"][task_id].values()))
+        title = index["titles"][task_id]
+        covered = 1.0 if query_words and query_words <= set(title.split()) else 0.0
+        contained = 1.0 if title and f" {title} " in f" {query_norm} " else 0.0
+        scores[task_id] = max(dice, covered, contained)
+    return scores
+
+
+# Returns {"task_id", "message"} like mark_as_done_prompt, or None when the LLM should decide.
+# load_tasks is only called when the user's index is missing or expired.
+def resolve_task(user_id, text, load_tasks):
+    with _lock:
+        index = _get_index(user_id, load_tasks)
+
+        m = _EXPLICIT_ID_RE.search(text.lower())
+        words = [w for w in normalize(text).split() if w not in COMMAND_WORDS]
+        if m is None and len(words) == 1 and words[0].isdigit():
+            task_id = int(words[0])
+        else:
+            task_id = int(m.group(1)) if m else None
+        if task_id is not None and task_id in index["titles"]:
+            _stats["explicit_id"] += 1
+            return {"task_id": task_id, "message": None}
+
+        query = " ".join(words)
+        if query:
+            ranked = sorted(_score(index, query).items(), key=lambda kv: kv[1], reverse=True)
+            if ranked:
+                best_id, best = ranked[0]
+                second = ranked[1][1] if len(ranked) > 1 else 0.0
+                if best >= TASK_MATCH_MIN_SCORE and best - second >= TASK_MATCH_MARGIN:
+                    _stats["fuzzy"] += 1
+                    return {"task_id": best_id, "message": None}
+
+        _stats["llm_fallback"] += 1
+        return None
+
+
+def task_index_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["users"] = len(_indexes)
+    return stats
@@ -1,14 +1,16 @@
-import requests
+import os
+import time
 
-from prompt import chat_prompt, create_task_prompt
+from prompt import chat_prompt, chat_stream_prompt, create_task_prompt
 from telegram.keyboards import *
-from database import get_or_create_user, mark_task_done, get_pending_tasks, set_user_state, get_user_state, \
-    clear_user_state
-
-import os
+from telegram.sender import telegram_request
+from database import get_or_create_user, mark_task_done, mark_tasks_done, get_pending_tasks_page
+from state_store import get_user_state, set_user_state, clear_user_state
 
-TELEGRAM_API = f"https://api.telegram.org/bot{os.getenv('TASKBOT_TELEGRAM_TOKEN')}/sendMessage"
 WELCOME_TEXT = "Hello!\nThis is early testing"
+# Free-text replies are streamed into one message edited every STREAM_EDIT_INTERVAL seconds
+STREAM_CHAT = os.getenv("TASKBOT_STREAM_CHAT", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("TASKBOT_STREAM_EDIT_INTERVAL", "1.0"))
 
 def send_message(chat_id, text, reply_markup=None):
     payload = {
@@ -19,7 +21,70 @@ def send_message(chat_id, text, reply_markup=None):
     if reply_markup:
         payload["reply_markup"] = reply_markup
 
-    requests.post(TELEGRAM_API, json=payload, timeout=10)
+    return telegram_request("sendMessage", payload, chat_id=chat_id)
+
+
+def edit_message(chat_id, message_id, text):
+    payload = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text,
+    }
+    return telegram_request("editMessageText", payload, chat_id=chat_id)
+
+
+def edit_reply_markup(chat_id, message_id, reply_markup):
+    payload = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "reply_markup": reply_markup,
+    }
+    return telegram_request("editMessageReplyMarkup", payload, chat_id=chat_id)
+
+
+# Sends the first chunk as soon as it arrives, then edits the message in place.
+# Returns the full text, or None when nothing was generated.
+def stream_message(chat_id, chunks):
+    text = ""
+    shown = ""
+    message_id = None
+    last_edit = 0.0
+
+    try:
+        for piece in chunks:
+            text += piece
+            if not text.strip():
+                continue
+            now = time.monotonic()
+            if message_id is None:
+                res = telegram_request("sendMessage", {"chat_id": chat_id, "text": text}, chat_id=chat_id)
+                if not res:
+                    continue
+                message_id = res["result"]["message_id"]
+                shown, last_edit = text, now
+            elif now - last_edit >= STREAM_EDIT_INTERVAL:
+                edit_message(chat_id, message_id, text)
+                shown, last_edit = text, now
+    except Exception as e:
+        # Once the user sees a message, keep what we have rather than sending a second one
+        if message_id is None:
+            raise
+        print("ERROR stream interrupted:", e)
+
+    if message_id is not None and text != shown:
+        edit_message(chat_id, message_id, text)
+
+    return text if message_id is not None else None
+
+
+def send_chat_reply(chat_id, text, user_id):
+    if STREAM_CHAT:
+        try:
+            if stream_message(chat_id, chat_stream_prompt(text, user_id)) is not None:
+                return
+        except Exception as e:
+            print("ERROR streaming chat reply, falling back:", e)
+    send_message(chat_id, chat_prompt(text, user_id))
 
 
 
@@ -57,8 +122,7 @@ def handle_message(message):
         return "ok", 200
 
     # 2️⃣ Otherwise → chat only
-    reply = chat_prompt(text, user_id)
-    send_message(chat_id, reply)
+    send_chat_reply(chat_id, text, user_id)
     return "ok", 200
 
 
@@ -72,14 +136,14 @@ def handle_text_action(action, chat_id, user_id):
             )
             send_message(chat_id, "Send me the task description.")
         case "task:mark_menu":
-            tasks = get_pending_tasks(user_id)
+            tasks, next_cursor = get_pending_tasks_page(user_id)
             if not tasks:
                 send_message(chat_id, "No tasks to mark as done.")
             else:
                 send_message(
                     chat_id,
-                    "Select a task to mark as done:",
-                    reply_markup=task_list_keyboard(tasks)
+                    "Select the tasks to mark as done:",
+                    reply_markup=task_list_keyboard(tasks, next_cursor)
                 )
         case "category:menu":
             send_message(
@@ -88,8 +152,7 @@ def handle_text_action(action, chat_id, user_id):
                 reply_markup=category_menu_keyboard()
             )
         case "task:list":
-            reply = chat_prompt("show tasks", user_id)
-            send_message(chat_id, reply)
+            send_chat_reply(chat_id, "show tasks", user_id)
         case _:
             send_message(chat_id,"Error, non existent action: " + action )
 
@@ -118,6 +181,28 @@ def handle_callback(cb):
         case ("task", "done"):
             mark_task_done(user_id, int(arg))
             send_message(chat_id, "Task marked as done.")
+        case ("task", "done_many"):
+            task_ids = [int(i) for i in arg.split(",") if i]
+            mark_tasks_done(user_id, task_ids)
+            # Refresh the list so the finished tasks and the selection disappear
+            tasks, next_cursor = get_pending_tasks_page(user_id)
+            edit_reply_markup(chat_id, cb["message"]["message_id"], task_list_keyboard(tasks, next_cursor))
+            send_message(chat_id, f"{len(task_ids)} tasks marked as done.")
+        case ("task", "toggle"):
+            markup = toggle_task_selection(cb["message"].get("reply_markup"), int(arg))
+            if markup is None:
+                send_message(chat_id, "That's as many as I can mark at once, mark the selected tasks first.")
+            else:
+                edit_reply_markup(chat_id, cb["message"]["message_id"], markup)
+        case ("task", "page"):
+            # Swap the keyboard of the same message, only this page is fetched
+            tasks, next_cursor = get_pending_tasks_page(user_id, arg)
+            selected = selected_task_ids(cb["message"].get("reply_markup"))
+            edit_reply_markup(
+                chat_id,
+                cb["message"]["message_id"],
+                task_list_keyboard(tasks, next_cursor, is_first_page=arg is None, selected=selected)
+            )
         case ("category", "menu"):
             send_message(
                 chat_id,
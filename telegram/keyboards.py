@@ -9,19 +9,83 @@ def main_menu_keyboard():
     }
 
 
-def task_list_keyboard(tasks):
-    return {
-        "inline_keyboard": [
-            [
-                {
-                    "text": f"✅ {t['title']}",
-                    "callback_data": f"task:done:{t['id']}"
-                }
-            ]
-            for t in tasks
+# Telegram rejects callback_data longer than this
+CALLBACK_DATA_LIMIT = 64
+UNSELECTED = "⬜"
+SELECTED = "☑️"
+
+
+# Tapping a task toggles it, the selection lives in the callback_data of the
+# "Mark selected done" button so it survives paging without server-side state
+def task_list_keyboard(tasks, next_cursor=None, is_first_page=True, selected=()):
+    rows = [
+        [
+            {
+                "text": f"{SELECTED if t['id'] in selected else UNSELECTED} {t['title']}",
+                "callback_data": f"task:toggle:{t['id']}"
+            }
         ]
+        for t in tasks
+    ]
+
+    nav = []
+    if not is_first_page:
+        nav.append({"text": "⏮ First", "callback_data": "task:page"})
+    if next_cursor:
+        nav.append({"text": "More ➡️", "callback_data": f"task:page:{next_cursor}"})
+    if nav:
+        rows.append(nav)
+
+    if selected:
+        rows.append([_done_many_button(selected)])
+
+    return {"inline_keyboard": rows}
+
+
+def _done_many_button(selected):
+    return {
+        "text": f"✅ Mark {len(selected)} done",
+        "callback_data": "task:done_many:" + ",".join(map(str, selected))
     }
 
+
+def selected_task_ids(markup):
+    for row in (markup or {}).get("inline_keyboard", []):
+        for button in row:
+            data = button.get("callback_data", "")
+            if data.startswith("task:done_many:"):
+                return [int(i) for i in data.rsplit(":", 1)[1].split(",") if i]
+    return []
+
+
+# Returns the markup with task_id's selection flipped,
+# or None when the selection would no longer fit in callback_data
+def toggle_task_selection(markup, task_id):
+    selected = selected_task_ids(markup)
+    if task_id in selected:
+        selected.remove(task_id)
+    else:
+        selected.append(task_id)
+    if selected and len(_done_many_button(selected)["callback_data"].encode()) > CALLBACK_DATA_LIMIT:
+        return None
+
+    rows = []
+    for row in markup.get("inline_keyboard", []):
+        if any(b.get("callback_data", "").startswith("task:done_many:") for b in row):
+            continue
+        new_row = []
+        for button in row:
+            data = button.get("callback_data", "")
+            if data.startswith("task:toggle:"):
+                mark = SELECTED if int(data.rsplit(":", 1)[1]) in selected else UNSELECTED
+                button = dict(button, text=f"{mark} {button['text'].split(' ', 1)[-1]}")
+            new_row.append(button)
+        rows.append(new_row)
+    if selected:
+        rows.append([_done_many_button(selected)])
+
+    return {"inline_keyboard": rows}
+
 def category_menu_keyboard():
     return {
         "inline_keyboard": [
@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Outbound Telegram Bot API calls over one keep-alive session, throttled by
+# token buckets (global and per chat) and retried on 429 / 5xx.
+# TASKBOT_TELEGRAM_API_BASE can point at a local fake server for tests.
+
+TELEGRAM_API_BASE = os.getenv("TASKBOT_TELEGRAM_API_BASE", "https://api.telegram.org")
+TELEGRAM_TOKEN = os.getenv("TASKBOT_TELEGRAM_TOKEN")
+
+# Telegram allows ~30 messages/s overall and ~1 message/s per chat
+GLOBAL_RATE = float(os.getenv("TASKBOT_TELEGRAM_GLOBAL_RATE", "30"))
+CHAT_RATE = float(os.getenv("TASKBOT_TELEGRAM_CHAT_RATE", "1"))
+CHAT_BURST = float(os.getenv("TASKBOT_TELEGRAM_CHAT_BURST", "3"))
+SEND_RETRIES = int(os.getenv("TASKBOT_TELEGRAM_RETRIES", "3"))
+SEND_TIMEOUT = 10
+MAX_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Takes one token, returns how long the caller has to wait for it
+    def reserve(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    # Used when Telegram says retry_after, nobody sends until then. Several 429s for
+    # the same flood wait must not add up, so this only ever extends to now + seconds.
+    def pause(self, seconds):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+_global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+_chat_buckets = OrderedDict()
+_lock = threading.Lock()
+
+_stats = {
+    "sent": 0,
+    "failed": 0,
+    "retries": 0,
+    "rate_limited": 0,
+    "throttle_seconds": 0.0,
+    "latency_seconds_total": 0.0,
+    "latency_seconds_max": 0.0,
+}
+
+
+def api_url(method):
+    return f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/{method}"
+
+
+def _chat_bucket(chat_id):
+    with _lock:
+        bucket = _chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(CHAT_RATE, CHAT_BURST)
+            _chat_buckets[chat_id] = bucket
+            if len(_chat_buckets) > MAX_CHAT_BUCKETS:
+                _chat_buckets.popitem(last=False)
+        else:
+            _chat_buckets.move_to_end(chat_id)
+        return bucket
+
+
+def _throttle(chat_id):
+    wait = _global_bucket.reserve()
+    if chat_id is not None:
+        wait = max(wait, _chat_bucket(chat_id).reserve())
+    if wait > 0:
+        with _lock:
+            _stats["throttle_seconds"] += wait
+        time.sleep(wait)
+
+
+def _record(key, value=1):
+    with _lock:
+        _stats[key] += value
+
+
+# Calls a Bot API method, returns the decoded JSON reply or None when all attempts failed
+def telegram_request(method, payload, chat_id=None):
+    started = time.monotonic()
+
+    for attempt in range(SEND_RETRIES + 1):
+        _throttle(chat_id)
+        retry_after = None
+        try:
+            request_started = time.perf_counter()
+            res = _session.post(api_url(method), json=payload, timeout=SEND_TIMEOUT)
+            metrics.observe(
+                "taskbot_telegram_request_seconds", time.perf_counter() - request_started,
+                method=method, status=str(res.status_code)
+            )
+            if res.status_code == 429:
+                _record("rate_limited")
+                try:
+                    retry_after = res.json().get("parameters", {}).get("retry_after")
+                except ValueError:
+                    pass
+                retry_after = float(retry_after or 1)
+                # retry_after may be the bot-wide flood limit, the other chats have to wait too
+                _global_bucket.pause(retry_after)
+                if chat_id is not None:
+                    _chat_bucket(chat_id).pause(retry_after)
+            elif res.status_code >= 500:
+                pass
+            elif not res.ok:
+                # 4xx other than 429 won't get better with a retry
+                print("ERROR telegram", method, res.status_code, res.text)
+                _record("failed")
+                metrics.inc("taskbot_telegram_failures_total", method=method)
+                return None
+            else:
+                elapsed = time.monotonic() - started
+                with _lock:
+                    _stats["sent"] += 1
+                    _stats["latency_seconds_total"] += elapsed
+                    _stats["latency_seconds_max"] = max(_stats["latency_seconds_max"], elapsed)
+                return res.json()
+        except requests.RequestException as e:
+            print("ERROR telegram", method, e)
+
+        if attempt < SEND_RETRIES:
+            _record("retries")
+            # 429 waits inside the bucket, everything else backs off exponentially
+            if retry_after is None:
+                time.sleep(min(0.5 * 2 ** attempt, 10))
+
+    _record("failed")
+    metrics.inc("taskbot_telegram_failures_total", method=method)
+    return None
+
+
+def send_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+        stats["chat_buckets"] = len(_chat_buckets)
+    stats["latency_seconds_avg"] = (
+        stats["latency_seconds_total"] / stats["sent"] if stats["sent"] else 0.0
+    )
+    return stats
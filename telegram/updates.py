@@ -0,0 +1,146 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from telegram.callbacks import handle_message, handle_callback
+
+# Background processing of Telegram updates, so the webhook can answer 200
+# before any LLM call runs and Telegram never redelivers a slow update.
+# Each worker owns a queue and a chat always maps to the same worker,
+# so updates from one chat are still handled in order.
+
+WEBHOOK_WORKERS = int(os.getenv("TASKBOT_WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("TASKBOT_WEBHOOK_QUEUE_SIZE", "1000"))
+DRAIN_TIMEOUT = float(os.getenv("TASKBOT_WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+_queues = [
+    queue.Queue(maxsize=max(1, WEBHOOK_QUEUE_SIZE // WEBHOOK_WORKERS))
+    for _ in range(WEBHOOK_WORKERS)
+]
+_workers = []
+_workers_pid = None
+_lock = threading.Lock()
+
+# Recently seen update_ids, Telegram may still redeliver after a network hiccup
+_seen_ids = set()
+_seen_order = deque(maxlen=10000)
+
+_stats = {
+    "enqueued": 0,
+    "processed": 0,
+    "failed": 0,
+    "rejected": 0,
+    "duplicates": 0,
+    "max_depth": 0,
+}
+
+_STOP = object()
+
+
+def process_update(data):
+    if "callback_query" in data:
+        return handle_callback(data["callback_query"])
+
+    if "message" in data:
+        return handle_message(data["message"])
+
+    return "ok", 200
+
+
+def _chat_id(data):
+    if "callback_query" in data:
+        return data["callback_query"]["message"]["chat"]["id"]
+    if "message" in data:
+        return data["message"]["chat"]["id"]
+    return data.get("update_id", 0)
+
+
+def _queue_depth():
+    return sum(q.qsize() for q in _queues)
+
+
+def _worker(q):
+    while True:
+        item = q.get()
+        try:
+            if item is _STOP:
+                return
+            process_update(item)
+            with _lock:
+                _stats["processed"] += 1
+        except Exception as e:
+            print("ERROR processing update:", e)
+            with _lock:
+                _stats["failed"] += 1
+        finally:
+            q.task_done()
+
+
+def _start_workers():
+    global _workers_pid
+    # Threads don't survive a fork, so gunicorn workers start their own pool
+    if _workers_pid == os.getpid():
+        return
+    _workers.clear()
+    for i in range(WEBHOOK_WORKERS):
+        t = threading.Thread(target=_worker, args=(_queues[i],), name=f"update-worker-{i}", daemon=True)
+        t.start()
+        _workers.append(t)
+    _workers_pid = os.getpid()
+
+
+# Returns False when the update could not be queued (queue full)
+def enqueue_update(data) -> bool:
+    with _lock:
+        _start_workers()
+
+        update_id = data.get("update_id")
+        if update_id is not None:
+            if update_id in _seen_ids:
+                _stats["duplicates"] += 1
+                return True
+            if len(_seen_order) == _seen_order.maxlen:
+                _seen_ids.discard(_seen_order[0])
+            _seen_order.append(update_id)
+            _seen_ids.add(update_id)
+
+        try:
+            _queues[hash(_chat_id(data)) % len(_queues)].put_nowait(data)
+        except queue.Full:
+            _stats["rejected"] += 1
+            _seen_ids.discard(update_id)
+            return False
+
+        _stats["enqueued"] += 1
+        _stats["max_depth"] = max(_stats["max_depth"], _queue_depth())
+        return True
+
+
+def drain_updates(timeout=DRAIN_TIMEOUT):
+    global _workers_pid
+    if _workers_pid != os.getpid():
+        return
+
+    deadline = time.monotonic() + timeout
+    for q in _queues:
+        try:
+            q.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Full:
+            break
+    for t in _workers:
+        t.join(max(0.0, deadline - time.monotonic()))
+    _workers_pid = None
+
+
+def update_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+    stats["queue_depth"] = _queue_depth()
+    stats["workers"] = sum(t.is_alive() for t in _workers)
+    return stats
+
+
+atexit.register(drain_updates)
@@ -1,16 +1,20 @@
-import requests
+import os
 from flask import request
-from telegram.callbacks import handle_message, handle_callback
+from telegram.updates import enqueue_update, process_update
 
+# Set to 0 to handle updates inside the request (debugging, benchmarks)
+WEBHOOK_ASYNC = os.getenv("TASKBOT_WEBHOOK_ASYNC", "1") == "1"
 
 
 def telegram_webhook():
     data = request.json
     print("DEBUG WEBHOOK DATA: ", data)
-    if "callback_query" in data:
-        return handle_callback(data["callback_query"])
 
-    if "message" in data:
-        return handle_message(data["message"])
+    if not WEBHOOK_ASYNC:
+        return process_update(data)
+
+    if not enqueue_update(data):
+        # Queue is full, a non-200 makes Telegram retry later instead of losing the update
+        return "busy", 503
 
     return "ok", 200